@@ -0,0 +1,90 @@
+"""Compare IRCLine.parse against the previous deque/regex based parser
+
+Usage: python bench/irc_parse.py [iterations]
+"""
+from chatrelay.irc import IRCLine
+from timeit import timeit
+import collections
+import re
+import sys
+
+class LegacyHandleInfo(object):
+    def __init__(self):
+        self.nick = None
+        self.user = None
+        self.host = None
+
+    @classmethod
+    def parse(cls, handle):
+        match = re.search(r'^([^!]+)!([^@]+)@(.+)$', handle.strip())
+        ret = cls()
+        if match is not None:
+            ret.nick = match.group(1)
+            ret.user = match.group(2)
+            ret.host = match.group(3)
+        return ret
+
+class LegacyIRCLine(object):
+    def __init__(self):
+        self.prefix = None
+        self.cmd = None
+        self.args = []
+        self.text = ''
+        self.raw = None
+        self.handle = LegacyHandleInfo()
+
+    @classmethod
+    def parse(cls, line):
+        ret = cls()
+        ret.raw = line
+        tokens = collections.deque(line.strip().split(' '))
+        if tokens[0][0:1] == ':':
+            ret.prefix = tokens.popleft()[1:]
+            ret.handle = LegacyHandleInfo.parse(ret.prefix)
+        ret.cmd = tokens.popleft()
+        text_words = []
+        ontext = False
+        for token in tokens:
+            if not ontext:
+                if token.strip() == '':
+                    continue
+                if token.lstrip()[0:1] == ':':
+                    ontext = True
+                    text_words.append(token.lstrip()[1:])
+                else:
+                    ret.args.append(token.strip())
+            else:
+                text_words.append(token)
+        ret.text = ' '.join(text_words)
+        return ret
+
+LINES = [
+    ':somenick!~someuser@host.example.org PRIVMSG #channel :hello there, this is a fairly typical chat line',
+    ':irc.example.org 372 relay :- Message of the day line with some text in it',
+    'PING :irc.example.org',
+    ':001AAAAAB PRIVMSG #channel :a message relayed over the server link to the channel',
+    ':0AB UID somenick 0 1500000000 user host.example.org 0ABAAAAAC 0 +i * * :Real Name',
+    ':other!u@h.example.org PRIVMSG #random :short',
+]
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    for line in LINES:
+        old = LegacyIRCLine.parse(line)
+        new = IRCLine.parse(line)
+        assert (old.prefix, old.cmd, old.args, old.text) == (new.prefix, new.cmd, new.args, new.text), line
+
+    count = iterations * len(LINES)
+    # the relay path reads the nick of every PRIVMSG
+    def parse_new():
+        for line in LINES:
+            parsed = IRCLine.parse(line)
+            if parsed.cmd == 'PRIVMSG':
+                parsed.handle.nick
+    t_old = timeit(lambda: [LegacyIRCLine.parse(line) for line in LINES], number=iterations)
+    t_new = timeit(parse_new, number=iterations)
+    print('legacy: {0:10.0f} lines/sec'.format(count / t_old))
+    print('parse:  {0:10.0f} lines/sec ({1:.1f}x)'.format(count / t_new, t_old / t_new))
+
+if __name__ == '__main__':
+    main()
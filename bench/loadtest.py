@@ -0,0 +1,413 @@
+"""Replay recorded traffic through the real connections against local fake servers
+
+Record a trace by setting `record_file` in the config of a running relay, then
+replay it with the same config:
+
+Usage: python bench/loadtest.py config.yaml trace.jsonl [speed] [idle]
+
+Every irc, unrealserv, slackbot and matrix_as connection in the config is
+pointed at a fake IRC server, UnrealIRCd uplink, Slack RTM websocket and Web
+API, or Matrix homeserver listening on localhost; other connections are left
+out. Once all of them are connected,
+the recorded inbound traffic is sent to the relay by the fakes `speed` times
+faster than it was recorded (default 1). Each replayed message is tagged so its
+deliveries can be matched up. The run ends when nothing has been delivered for
+`idle` seconds (default 5) after the last of the trace.
+
+Queue rate limits from the config still apply, so remove them to measure raw
+throughput. Peak RSS covers the relay and the fake servers, which share the
+process.
+"""
+from chatrelay import servers, tobytes, tostr
+from chatrelay.irc import IRCLine
+from chatrelay.main import start
+from chatrelay.web import JSONClient
+from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from twisted.internet import reactor
+from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from time import time
+import json
+import logging
+import re
+import resource
+import socket
+import sys
+import yaml
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+_token_re = re.compile(r' \[lt:(\d+)\]')
+
+class FakeIRC(LineReceiver):
+    """Accepts an IRC client or a server link, depending on the factory"""
+
+    def connectionMade(self):
+        if self.factory.uplink:
+            self.factory.proto = self
+
+    def connectionLost(self, reason):
+        if self.factory.proto is self:
+            self.factory.proto = None
+
+    def lineReceived(self, raw_line):
+        line = IRCLine.parse(tostr(raw_line))
+        if line.cmd == 'NICK' and not self.factory.uplink and line.args and line.args[0] == self.factory.nick:
+            # in pool mode only the primary connection relays, inject there
+            self.factory.proto = self
+        elif line.cmd == 'PRIVMSG':
+            self.factory.harness.delivered(line.text)
+        elif line.cmd == 'PING':
+            self.sendLine(tobytes(u'PONG :{0}'.format(line.text)))
+        elif line.cmd == 'USER' and not self.factory.uplink:
+            self.sendLine(b':fake.server 001 relay :Welcome')
+        elif line.cmd == 'EOS' and self.factory.uplink:
+            self.sendLine(b':001 EOS')
+
+    def inject(self, data):
+        self.sendLine(tobytes(data))
+
+
+class FakeIRCFactory(ServerFactory):
+    protocol = FakeIRC
+    proto = None
+
+    def __init__(self, harness, uplink):
+        self.harness = harness
+        self.uplink = uplink
+
+    def listen(self, conf):
+        self.nick = conf.get('nick')
+        port = reactor.listenTCP(0, self, interface='127.0.0.1')
+        conf['host'] = '127.0.0.1'
+        conf['port'] = port.getHost().port
+        conf['ssl'] = False
+
+
+class FakeRTM(WebSocketServerProtocol):
+    def onOpen(self):
+        self.factory.proto = self
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.proto = None
+
+    def inject(self, data):
+        self.sendMessage(tobytes(data))
+
+
+class FakeSlackAPI(Resource):
+    """The Slack Web API methods used by chatrelay.slack"""
+
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render_POST(self, request):
+        method = tostr(request.path).rsplit('/', 1)[-1]
+        args = dict((tostr(k), tostr(v[0])) for k, v in request.args.items())
+        request.setHeader(b'Content-Type', b'application/json')
+        return tobytes(json.dumps(self.factory.call(method, args)))
+
+
+class FakeSlackFactory(WebSocketServerFactory):
+    """Slack RTM websocket and Web API
+
+    Users and channels are named as resolved when the trace was recorded
+    """
+
+    protocol = FakeRTM
+    proto = None
+
+    def __init__(self, harness):
+        WebSocketServerFactory.__init__(self)
+        # like Slack, agree to permessage-deflate if offered
+        self.setProtocolOptions(perMessageCompressionAccept=self._accept_deflate)
+        self.harness = harness
+        self.users = {}
+        self.channels = {}
+
+    def _accept_deflate(self, offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(offer)
+
+    def listen(self, conf):
+        port = reactor.listenTCP(0, self, interface='127.0.0.1')
+        self.wsurl = 'ws://127.0.0.1:{0}/'.format(port.getHost().port)
+        api = reactor.listenTCP(0, Site(FakeSlackAPI(self)), interface='127.0.0.1')
+        conf['api_url'] = 'http://127.0.0.1:{0}/api/'.format(api.getHost().port)
+
+    def call(self, method, args):
+        if method == 'rtm.connect':
+            return {'ok': True, 'url': self.wsurl}
+        elif method == 'rtm.start':
+            return {
+                'ok': True,
+                'url': self.wsurl,
+                'users': [{'id': id, 'name': name} for id, name in self.users.items()],
+                'channels': [{'id': id, 'name': name, 'is_member': True} for id, name in self.channels.items()],
+            }
+        elif method == 'users.info':
+            id = args['user']
+            return {'ok': True, 'user': {'id': id, 'name': self.users.get(id, id)}}
+        elif method == 'conversations.info':
+            id = args['channel']
+            return {'ok': True, 'channel': {'id': id, 'name': self.channels.get(id, id), 'is_member': True}}
+        elif method == 'chat.postMessage':
+            self.harness.delivered(args['text'])
+            return {'ok': True}
+        return {'ok': False, 'error': 'unknown_method'}
+
+
+class FakeHomeserverAPI(Resource):
+    """The Matrix client-server API methods used by chatrelay.appservice"""
+
+    isLeaf = True
+
+    def __init__(self, factory):
+        Resource.__init__(self)
+        self.factory = factory
+
+    def render(self, request):
+        path = [unquote(tostr(p)) for p in request.postpath]
+        body = request.content.read()
+        request.setHeader(b'Content-Type', b'application/json')
+        return tobytes(json.dumps(self.factory.call(tostr(request.method), path[3:], body)))
+
+
+class FakeHomeserver(object):
+    """Matrix homeserver with an application service registered
+
+    Rooms have the IDs they had when the trace was recorded. Events are pushed
+    to the relay in transactions, one at a time like a real homeserver, so
+    events injected meanwhile are batched into the next one.
+    """
+
+    proto = None
+
+    def __init__(self, harness):
+        self.harness = harness
+        self.channels = {}
+        self.users = {}
+        self.pending = []
+        self.sending = False
+        self.txn = 0
+        self.client = JSONClient(1)
+
+    def listen(self, conf):
+        port = reactor.listenTCP(0, Site(FakeHomeserverAPI(self)), interface='127.0.0.1')
+        conf['homeserver_url'] = 'http://127.0.0.1:{0}'.format(port.getHost().port)
+        conf['listen_bind'] = '127.0.0.1'
+        conf['listen_port'] = free_port()
+        self.conf = conf
+
+    def call(self, method, path, body):
+        if path[0] == 'register':
+            if json.loads(tostr(body))['username'] == self.conf['sender_localpart']:
+                self.proto = self
+            return {'user_id': 'registered'}
+        elif path[0] == 'directory':
+            aliases = dict((name, id) for id, name in self.channels.items())
+            return {'room_id': aliases.get(path[2], '!' + path[2])}
+        elif path[0] == 'rooms' and path[2] == 'send':
+            self.harness.delivered(json.loads(tostr(body))['body'])
+            return {'event_id': '$' + path[-1]}
+        elif path[0] == 'join':
+            return {'room_id': path[1]}
+        return {}
+
+    def inject(self, data):
+        self.pending.append(json.loads(data))
+        if not self.sending:
+            self._send()
+
+    def _send(self):
+        if not self.pending:
+            self.sending = False
+            return
+        self.sending = True
+        events, self.pending = self.pending, []
+        self.txn += 1
+        url = 'http://127.0.0.1:{0}/_matrix/app/v1/transactions/{1}'.format(self.conf['listen_port'], self.txn)
+        d = self.client.request('PUT', url, params={'access_token': self.conf['hs_token']}, json_body={'events': events})
+        d.addBoth(lambda _: self._send())
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+FAKES = {
+    'IRCFactory': lambda harness: FakeIRCFactory(harness, uplink=False),
+    'UnrealServFactory': lambda harness: FakeIRCFactory(harness, uplink=True),
+    'SlackWSFactory': FakeSlackFactory,
+    'AppServiceRelay': FakeHomeserver,
+}
+
+class Harness(object):
+    def __init__(self, conf, trace, speed, idle):
+        self.speed = speed
+        self.idle = idle
+        self.fakes = {}
+        self.injected = []
+        self.latencies = []
+        self.delivered_count = 0
+        self.last_delivery = None
+
+        supported = []
+        for server in conf['servers']:
+            objname = conf['protocols'][server['protocol']][1]
+            if objname in FAKES:
+                fake = self.fakes[server['name']] = FAKES[objname](self)
+                fake.listen(server)
+                # never touch the real on-disk buffers of a production config
+                for key in list(server):
+                    if key == 'replay_file' or key.startswith('spool_'):
+                        del server[key]
+                supported.append(server)
+            else:
+                print('Leaving out {0}, no fake for protocol {1}'.format(server['name'], server['protocol']))
+        conf['servers'] = supported
+        conf['log_level'] = 'WARNING'
+        for key in ('log_file', 'metrics_port', 'record_file'):
+            conf.pop(key, None)
+        self.conf = conf
+
+        # name resolutions are served by the fakes rather than replayed
+        self.trace = []
+        for stamp, server, kind, data in trace:
+            if server not in self.fakes:
+                continue
+            if kind == 'channel':
+                self.fakes[server].channels[data[0]] = data[1]
+            elif kind == 'user':
+                self.fakes[server].users[data[0]] = data[1]
+            else:
+                self.trace.append((stamp, server, kind, data))
+
+    def run(self):
+        start(self.conf)
+        self.started = time()
+        self._wait = LoopingCall(self._check_connected)
+        self._wait.start(0.1)
+        reactor.run()
+
+    def _check_connected(self):
+        if all(fake.proto is not None and name in servers for name, fake in self.fakes.items()):
+            self._wait.stop()
+            print('Connected in {0:.2f}s, replaying {1} entries at {2}x'.format(
+                time() - self.started, len(self.trace), self.speed))
+            self.pos = 0
+            self.replay_start = time()
+            reactor.callLater(0, self._replay)
+        elif time() - self.started > 30:
+            print('Timed out waiting for connections: {0}'.format(
+                ', '.join(name for name, fake in self.fakes.items() if fake.proto is None)))
+            self._wait.stop()
+            reactor.stop()
+
+    def _replay(self):
+        """Inject every entry that is due, then wait for the next one"""
+        t0 = self.trace[0][0] if self.trace else 0
+        now = time() - self.replay_start
+        while self.pos < len(self.trace):
+            stamp, server, kind, data = self.trace[self.pos]
+            due = (stamp - t0) / self.speed
+            if due > now:
+                reactor.callLater(due - now, self._replay)
+                return
+            self.fakes[server].proto.inject(self._tag(kind, data))
+            self.pos += 1
+        self.replay_end = time()
+        self._done = LoopingCall(self._check_done)
+        self._done.start(0.5, now=False)
+
+    def _tag(self, kind, data):
+        """Append a token identifying this injection to message text"""
+        if kind == 'line':
+            line = IRCLine.parse(data)
+            if line.cmd != 'PRIVMSG' or not line.text:
+                return data
+            tagged = data
+        elif kind == 'event':
+            event = json.loads(data)
+            if event.get('type') != 'm.room.message' or not event.get('content', {}).get('body'):
+                return data
+            tagged = event
+        else:
+            msg = json.loads(data)
+            if msg.get('type') != 'message' or not msg.get('text'):
+                return data
+            tagged = msg
+        token = ' [lt:{0}]'.format(len(self.injected))
+        self.injected.append(time())
+        if kind == 'line':
+            return tagged + token
+        elif kind == 'event':
+            tagged['content']['body'] += token
+        else:
+            tagged['text'] += token
+        return json.dumps(tagged)
+
+    def delivered(self, text):
+        now = time()
+        self.last_delivery = now
+        # merged deliveries carry the tag of every message in them
+        tokens = _token_re.findall(text)
+        self.delivered_count += len(tokens) or 1
+        for token in tokens:
+            self.latencies.append(now - self.injected[int(token)])
+
+    def _check_done(self):
+        last = max(self.replay_end, self.last_delivery or 0)
+        if time() - last >= self.idle:
+            self._done.stop()
+            self.report()
+            reactor.stop()
+
+    def report(self):
+        end = self.last_delivery or self.replay_end
+        elapsed = max(end - self.replay_start, 1e-9)
+        print('Replayed {0} messages in {1:.2f}s'.format(len(self.injected), self.replay_end - self.replay_start))
+        print('Delivered {0} messages in {1:.2f}s: {2:.0f} msgs/sec'.format(
+            self.delivered_count, elapsed, self.delivered_count / elapsed))
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            print('Latency p50 {0:.2f}ms p99 {1:.2f}ms max {2:.2f}ms'.format(
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+        # ru_maxrss is in kilobytes on Linux
+        print('Peak RSS {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def percentile(values, p):
+    """`p`th percentile of sorted `values`, nearest rank"""
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+def load_trace(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    logging.getLogger('chatrelay').addHandler(logging.NullHandler())
+    with open(sys.argv[1]) as f:
+        conf = yaml.safe_load(f)
+    trace = load_trace(sys.argv[2])
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    idle = float(sys.argv[4]) if len(sys.argv) > 4 else 5.0
+    Harness(conf, trace, speed, idle).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Relay throughput from an IRC connection to another under different logging setups
+
+Usage: python bench/relay_logging.py [messages]
+"""
+from chatrelay.irc import IRC
+from chatrelay.logsetup import SampleFilter, ThreadQueueHandler
+from chatrelay.outbound import OutboundQueue
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+from timeit import default_timer
+import chatrelay
+import logging
+import logging.handlers
+import os
+import sys
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger('chatrelay')
+trace = logging.getLogger('chatrelay.trace')
+
+def setup():
+    for name in ('a', 'b'):
+        chatrelay.queues[name] = OutboundQueue({'name': name})
+    conf = {'name': 'a', 'channel_map': {'#chan': {'b': '#chan'}}}
+    chatrelay.build_router(conf)
+    dest = IRC({'name': 'b'})
+    dest.transport = StringTransport()
+    dest.connected = 1
+    chatrelay.register('b', dest)
+    return IRC(conf), dest
+
+def run(source, dest, count):
+    line = b':someone!user@host.example.org PRIVMSG #chan :a line of chat that gets relayed'
+    start = default_timer()
+    for i in range(count):
+        source.lineReceived(line)
+        if i % 100 == 0:
+            reactor.iterate()
+            dest.transport.clear()
+    reactor.iterate()
+    reactor.iterate()
+    return count / (default_timer() - start)
+
+def configure(level, handler_level, async_, sample=1.0):
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    for f in list(trace.filters):
+        trace.removeFilter(f)
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setLevel(handler_level)
+    listener = None
+    if async_:
+        queue = Queue()
+        listener = logging.handlers.QueueListener(queue, handler, respect_handler_level=True)
+        listener.start()
+        logger.addHandler(ThreadQueueHandler(queue))
+    else:
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    if sample < 1.0:
+        trace.addFilter(SampleFilter(sample))
+    return listener
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    source, dest = setup()
+    cases = [
+        ('log_level INFO, previous relay.py (logger at DEBUG)', logging.DEBUG, logging.INFO, False, 1.0),
+        ('log_level INFO', logging.INFO, logging.INFO, True, 1.0),
+        ('log_level DEBUG, sync handler', logging.DEBUG, logging.DEBUG, False, 1.0),
+        ('log_level DEBUG', logging.DEBUG, logging.DEBUG, True, 1.0),
+        ('log_level DEBUG, log_trace_sample 0.01', logging.DEBUG, logging.DEBUG, True, 0.01),
+    ]
+    for desc, level, handler_level, async_, sample in cases:
+        listener = configure(level, handler_level, async_, sample)
+        rate = run(source, dest, count)
+        if listener is not None:
+            listener.stop()
+        print('{0:52} {1:10.0f} msgs/sec'.format(desc, rate))
+
+if __name__ == '__main__':
+    main()
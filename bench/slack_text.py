@@ -0,0 +1,45 @@
+"""Compare MessageTransform against the previous chain of re.sub/str.replace calls
+
+Usage: python bench/slack_text.py [emoji_count] [iterations]
+"""
+from chatrelay.slack import MessageTransform
+from timeit import timeit
+import re
+import sys
+
+users = {'U{0:05d}'.format(i): 'user{0}'.format(i) for i in range(100)}
+
+def legacy(mtext, emoji_map):
+    def replace_userid(m):
+        return '@' + users.get(m.group(1), 'unknown')
+    mtext = re.sub(r'<@U[A-Z0-9]+\|([^>]+)>', r'@\1', mtext)
+    mtext = re.sub(r'<@(U[A-Z0-9]+)>', replace_userid, mtext)
+    mtext = re.sub(r'<#C[A-Z0-9]+\|([^>]+)>', r'#\1', mtext)
+    for name, emoji in emoji_map.items():
+        mtext = mtext.replace(name, emoji)
+    return mtext
+
+def main():
+    emoji_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    emoji_map = {':emoji_{0}:'.format(i): '<{0}>'.format(i) for i in range(emoji_count)}
+    messages = [
+        'hey <@U00001> have you seen <#C12345|general> :emoji_7: :emoji_1499:',
+        'plain text message without any markup at all, just words ' * 3,
+        '<@U00002|bob> :emoji_3::emoji_30: :not_mapped: <@U00099> done',
+    ]
+
+    transform = MessageTransform(emoji_map)
+    user_name = lambda id: users.get(id, 'unknown')
+    for msg in messages:
+        assert transform.apply(msg, user_name) == legacy(msg, emoji_map), msg
+
+    count = iterations * len(messages)
+    t_old = timeit(lambda: [legacy(m, emoji_map) for m in messages], number=iterations)
+    t_new = timeit(lambda: [transform.apply(m, user_name) for m in messages], number=iterations)
+    print('emoji_map entries: {0}'.format(emoji_count))
+    print('legacy:    {0:10.0f} msgs/sec'.format(count / t_old))
+    print('transform: {0:10.0f} msgs/sec ({1:.1f}x)'.format(count / t_new, t_old / t_new))
+
+if __name__ == '__main__':
+    main()
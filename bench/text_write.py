@@ -0,0 +1,39 @@
+"""Count transport writes for bursts of relayed IRC lines with and without corking
+
+Usage: python bench/text_write.py [burst_size] [bursts]
+"""
+from chatrelay.irc import IRC
+from twisted.internet import reactor
+from twisted.internet.testing import StringTransport
+import sys
+
+class CountingTransport(StringTransport):
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+def run(cork, burst_size, bursts):
+    conf = {'name': 'bench', 'cork': cork}
+    proto = IRC(conf)
+    transport = CountingTransport()
+    # skip connectionMade, only relayed lines are of interest
+    proto.transport = transport
+    proto.connected = 1
+    for i in range(bursts):
+        for j in range(burst_size):
+            proto.relay_message('#channel', 'message {0} of a paste'.format(j), 'someone', 'slack')
+        # let the reactor turn so corked lines are flushed
+        reactor.iterate()
+    return transport.writes, len(transport.value())
+
+def main():
+    burst_size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bursts = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    for cork in (False, True):
+        writes, size = run(cork, burst_size, bursts)
+        print('cork={0!s:5} lines={1} writes={2} bytes={3}'.format(cork, burst_size * bursts, writes, size))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,202 @@
 from twisted.internet.protocol import ClientFactory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor, ssl
+from . import dedup, metrics
+from twisted.internet.task import LoopingCall
+from collections import OrderedDict
+from time import time
 import logging
+import random
 import sys
 
 __all__ = []
 logger = logging.getLogger('chatrelay')
+# every protocol line/event goes to this child logger, see chatrelay.logsetup
+trace = logging.getLogger('chatrelay.trace')
 
 servers = {}
+queues = {}
+routers = {}
+# name -> object returned by init_connection(), stop() ends the connection
+connections = {}
+
+def relay(dest, destchan, message, fromnick=None, fromserver=None):
+    """Queue a message for delivery by the `dest` connection"""
+    queues[dest].put(destchan, message, fromnick, fromserver)
+
+class Router(object):
+    """Precompiled channel_map for one connection
+
+    Maps case-folded local channel names to a list of (OutboundQueue, destchan)
+    """
+
+    def __init__(self, conf):
+        self.name = conf['name']
+        self.routes = {}
+        for mychan, map in conf['channel_map'].items():
+            dests = self.routes.setdefault(mychan.lower(), [])
+            for dest, destchan in map.items():
+                try:
+                    dests.append((queues[dest], destchan))
+                except KeyError:
+                    logger.error('{0} :: channel_map for {1} names unknown server {2}'.format(self.name, mychan, dest))
+
+    def get(self, chan):
+        return self.routes.get(chan.lower(), ())
+
+    def all(self):
+        for dests in self.routes.values():
+            for dest in dests:
+                yield dest
+
+def build_router(conf):
+    """(Re)build the router for a connection, call whenever its channel_map changes"""
+    routers[conf['name']] = Router(conf)
+
+def route(fromserver, chan, message, fromnick=None, transform=None, received=None):
+    """Central dispatch for a message received on `chan` of the `fromserver` connection
+
+    If the channel is mapped anywhere, `transform(message)` is applied once to
+    get the text to relay, and nothing is relayed if that is empty. Echoes of
+    messages we relayed and duplicates are dropped, see chatrelay.dedup. Each
+    destination is handled independently so one failure can't affect the rest.
+    `received` is the time the message arrived, for latency metrics.
+    """
+    dests = routers[fromserver].get(chan)
+    if not dests:
+        return
+    timed = metrics.enabled
+    if transform is not None:
+        if timed:
+            start = time()
+        message = transform(message)
+        if timed:
+            metrics.observe('transform', fromserver, time() - start)
+        if not message:
+            return
+    if timed:
+        start = time()
+    seen = dedup.cache
+    if seen.enabled:
+        fp = seen.fingerprint(fromnick, message)
+        source = seen.source(fromserver, chan, fromnick)
+        if seen.check(fromserver, chan, fp, source):
+            seen.suppressed += 1
+            logger.debug('%s :: Suppressed echo or duplicate message in %s', fromserver, chan)
+            return
+    else:
+        fp = None
+    for queue, destchan in dests:
+        if fp is not None and seen.check(queue.name, destchan, fp, source):
+            seen.skipped += 1
+            continue
+        try:
+            queue.put(destchan, message, fromnick, fromserver, received)
+        except Exception:
+            logger.exception('{0} :: Failed to queue message for {1}'.format(fromserver, queue.name))
+    if timed:
+        metrics.observe('route', fromserver, time() - start)
+
+def unregister(name, proto=None):
+    """Remove a protocol object whose connection went down
+
+    Messages for `name` are held for replay until it is registered again. If
+    `proto` is given, only remove it if it is still the registered object.
+    """
+    if proto is None or servers.get(name) is proto:
+        servers.pop(name, None)
+
+def register(name, proto):
+    """Register a connected protocol object and flush anything queued for it"""
+    servers[name] = proto
+    try:
+        queue = queues[name]
+    except KeyError:
+        return
+    queue.resume()
+
+def announce(name, message):
+    """Send a service message from the `name` connection to all its mapped destinations"""
+    for queue, destchan in routers[name].all():
+        try:
+            queue.put(destchan, message)
+        except Exception:
+            logger.warn('{0} :: Failed to announce to {1}'.format(name, queue.name))
+
+class Backoff(object):
+    """Exponential reconnect delay with jitter
+
+    The delay doubles on every attempt from `reconnect_initial` up to
+    `reconnect_max` seconds, and is reset once a connection has stayed up for
+    `reconnect_stable` seconds
+    """
+
+    def __init__(self, conf):
+        self.initial = conf.get('reconnect_initial', 2)
+        self.max = conf.get('reconnect_max', 300)
+        self.stable = conf.get('reconnect_stable', 60)
+        self.attempts = 0
+        self.connected_at = None
+
+    def connected(self):
+        self.connected_at = time()
+
+    def next_delay(self):
+        if self.connected_at is not None and time() - self.connected_at >= self.stable:
+            self.attempts = 0
+        self.connected_at = None
+        delay = min(self.max, self.initial * 2 ** self.attempts)
+        self.attempts += 1
+        return round(random.uniform(delay / 2.0, delay), 1)
+
+class LRUCache(object):
+    """Mapping that holds at most `maxsize` entries, each for at most `ttl` seconds
+
+    Entries never expire if `ttl` is None
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, key):
+        expires, value = self._data.pop(key)
+        if expires is not None and expires < time():
+            raise KeyError(key)
+        self._data[key] = (expires, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        if self.ttl is None:
+            self._data[key] = (None, value)
+        else:
+            self._data[key] = (time() + self.ttl, value)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [value for expires, value in self._data.values()]
 
 def tobytes(s):
     if sys.version_info >= (3, 0):
@@ -24,50 +213,142 @@ def tostr(b):
 class TextProto(LineReceiver):
     """Basics for a text-based protocol"""
 
+    last_seen = 0
+    _keepalive = None
+    _pinged = False
+    _outbuf = None
+
     def sendLine(self, line):
-        logger.debug(u'{0} => {1}'.format(self.conf['name'], line))
-        LineReceiver.sendLine(self, tobytes(line))
+        trace.debug(u'%s => %s', self.conf['name'], line)
+        if not self.conf.get('cork', True):
+            LineReceiver.sendLine(self, tobytes(line))
+            return
+        if self._outbuf is None:
+            self._outbuf = []
+            reactor.callLater(0, self.flush)
+        self._outbuf.append(line)
+
+    def sendLines(self, lines):
+        """Send several lines, written together in corked mode"""
+        for line in lines:
+            self.sendLine(line)
+
+    def flush(self):
+        """Write out all lines sent during this reactor turn with a single write"""
+        buf = self._outbuf
+        self._outbuf = None
+        if buf and self.connected:
+            buf.append('')
+            self.transport.write(tobytes(u'\r\n'.join(buf)))
+
+    def dataReceived(self, data):
+        self.last_seen = time()
+        self._pinged = False
+        LineReceiver.dataReceived(self, data)
+
+    def start_keepalive(self):
+        """Probe the link with send_ping() after `ping_interval` idle seconds and
+        drop it if nothing arrives within `ping_timeout` more seconds"""
+        self.ping_interval = self.conf.get('ping_interval', 60)
+        self.ping_timeout = self.conf.get('ping_timeout', 15)
+        if not self.ping_interval:
+            return
+        self.last_seen = time()
+        self._keepalive = LoopingCall(self._check_alive)
+        self._keepalive.start(min(self.ping_interval, self.ping_timeout), now=False)
+
+    def _check_alive(self):
+        idle = time() - self.last_seen
+        if idle >= self.ping_interval + self.ping_timeout:
+            logger.error('{0} :: No response for {1:.0f}s, dropping connection'.format(self.conf['name'], idle))
+            self.transport.abortConnection()
+        elif idle >= self.ping_interval and not self._pinged:
+            self._pinged = True
+            self.send_ping()
+
+    def send_ping(self):
+        raise NotImplementedError()
 
+    def connectionLost(self, reason):
+        if self._keepalive is not None and self._keepalive.running:
+            self._keepalive.stop()
+        self._outbuf = None
+        LineReceiver.connectionLost(self, reason)
+
+
+def changed_keys(conf, new):
+    """Names of settings that differ between two entries of `servers`"""
+    return set(key for key in set(conf) | set(new) if conf.get(key) != new.get(key))
+
+def update_conf(conf, new):
+    """Replace the settings of a running connection in place, protocol objects share the dict"""
+    conf.clear()
+    conf.update(new)
 
 class BasicFactory(ClientFactory):
     """Common factory functions"""
 
+    # settings reconfigure() can change without reconnecting
+    LIVE_KEYS = ('channel_map',)
+
     @classmethod
     def init_connection(cls, conf):
+        build_router(conf)
+        factory = cls(conf)
         if conf['ssl']:
-            reactor.connectSSL(conf['host'], conf['port'], cls(conf), ssl.ClientContextFactory())
+            factory.connector = reactor.connectSSL(conf['host'], conf['port'], factory, ssl.ClientContextFactory())
         else:
-            reactor.connectTCP(conf['host'], conf['port'], cls(conf))
+            factory.connector = reactor.connectTCP(conf['host'], conf['port'], factory)
+        return factory
+
+    @classmethod
+    def reconfigure(cls, conf, new):
+        """Apply `new` settings to the running connection for `conf`
+
+        Returns False without changing anything if a reconnect is needed
+        """
+        if changed_keys(conf, new) - set(cls.LIVE_KEYS):
+            return False
+        update_conf(conf, new)
+        return True
 
     def __init__(self, conf):
         self.conf = conf
+        self.backoff = Backoff(conf)
+        self.connector = None
+        self.stopping = False
+        self._reconnect = None
+
+    def stop(self):
+        """Disconnect for good"""
+        self.stopping = True
+        unregister(self.conf['name'])
+        if self._reconnect is not None and self._reconnect.active():
+            self._reconnect.cancel()
+        if self.connector is not None:
+            self.connector.disconnect()
 
     def buildProtocol(self, addr):
-        name = self.conf['name']
-        logger.debug('{0} :: buildProtocol'.format(name))
-        servers[name] = self.protocol(self.conf)
-        return servers[name]
+        # the protocol calls register() once the server has accepted it, so
+        # nothing is sent before registration completes
+        logger.debug('{0} :: buildProtocol'.format(self.conf['name']))
+        self.backoff.connected()
+        return self.protocol(self.conf)
 
     def clientConnectionLost(self, connector, reason):
         logger.error('{0} :: Connection lost ({1})'.format(self.conf['name'], reason))
-        try:
-            for map in self.conf['channel_map'].values():
-                for dest, destchan in map.items():
-                    servers[dest].relay_message(destchan, 'Lost connection to {0}, retrying in 30s'.format(self.conf['name']))
-        except Exception:
-            logger.warn('lost connection sendLine failed')
-        finally:
-            logger.info('{0} :: Retrying in 30s'.format(self.conf['name']))
-            reactor.callLater(30, connector.connect)
+        self._retry(connector, 'Lost connection to')
 
     def clientConnectionFailed(self, connector, reason):
         logger.error('{0} :: Connection failed ({1})'.format(self.conf['name'], reason))
-        try:
-            for map in self.conf['channel_map'].values():
-                for dest, destchan in map.items():
-                    servers[dest].relay_message(destchan, 'Failed to connect to {0}, retrying in 30s'.format(self.conf['name']))
-        except Exception:
-            logger.warn('failed connection sendLine failed')
-        finally:
-            logger.info('{0} :: Retrying in 30s'.format(self.conf['name']))
-            reactor.callLater(30, connector.connect)
+        self._retry(connector, 'Failed to connect to')
+
+    def _retry(self, connector, what):
+        if self.stopping:
+            return
+        name = self.conf['name']
+        unregister(name)
+        delay = self.backoff.next_delay()
+        announce(name, '{0} {1}, retrying in {2}s'.format(what, name, delay))
+        logger.info('{0} :: Retrying in {1}s'.format(name, delay))
+        self._reconnect = reactor.callLater(delay, connector.connect)
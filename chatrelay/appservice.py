@@ -0,0 +1,303 @@
+from . import build_router, route, register, unregister, metrics, recorder, trace, changed_keys, update_conf, tostr, Backoff, LRUCache
+from .web import JSONClient, HTTPError
+from twisted.internet import reactor, defer
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from time import time
+import json
+import logging
+import re
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+logger = logging.getLogger('chatrelay')
+
+_localpart_re = re.compile(r'[^a-z0-9._=/-]')
+
+def puppet_localpart(prefix, fromnick, fromserver):
+    """Matrix user localpart for the puppet of a relayed sender"""
+    return _localpart_re.sub(u'_', u'{0}{1}_{2}'.format(prefix, fromserver or u'', fromnick).lower())
+
+def errcode(failure):
+    """The Matrix errcode of a failed API call, or None"""
+    if not failure.check(HTTPError):
+        return None
+    try:
+        return json.loads(tostr(failure.value.body)).get('errcode')
+    except ValueError:
+        return None
+
+
+class MatrixAPI(JSONClient):
+    """Async Matrix client-server API client, authenticated as an application service"""
+
+    def __init__(self, conf):
+        JSONClient.__init__(self, conf.get('api_concurrency', 4), conf.get('api_timeout', 30))
+        self.url = conf['homeserver_url'].rstrip('/') + '/_matrix/client/v3'
+        self.headers = {'Authorization': 'Bearer ' + conf['as_token']}
+
+    def call(self, method, path, body=None, user_id=None):
+        """Returns a Deferred firing with the decoded response, acting as `user_id` if given"""
+        params = {'user_id': user_id} if user_id else None
+        return self.request(method, self.url + path, params=params, json_body=body, headers=self.headers)
+
+
+class TransactionResource(Resource):
+    """Receives events pushed by the homeserver, at /transactions/<txnId>
+    and /_matrix/app/v1/transactions/<txnId>
+    """
+
+    isLeaf = True
+
+    def __init__(self, relay):
+        Resource.__init__(self)
+        self.relay = relay
+
+    def render(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        token = request.args.get(b'access_token', [b''])[0]
+        auth = request.getHeader(b'authorization') or b''
+        if auth.startswith(b'Bearer '):
+            token = auth[7:]
+        if tostr(token) != self.relay.conf['hs_token']:
+            request.setResponseCode(403)
+            return b'{"errcode":"M_FORBIDDEN"}'
+
+        path = [tostr(p) for p in request.postpath if p]
+        if path[:3] == ['_matrix', 'app', 'v1']:
+            path = path[3:]
+        if request.method == b'PUT' and len(path) == 2 and path[0] == 'transactions':
+            self.relay.transaction(path[1], json.loads(tostr(request.content.read())))
+            return b'{}'
+
+        # users and rooms are never created on demand
+        request.setResponseCode(404)
+        return b'{"errcode":"M_NOT_FOUND"}'
+
+
+class AppServiceRelay(object):
+    """Matrix application service bridging rooms of an external homeserver
+
+    Messages relayed into Matrix are sent by a puppet user per sender, named
+    `puppet_prefix` + fromserver_fromnick, which the homeserver must grant to
+    this application service, see the config example.
+    """
+
+    # settings reconfigure() can change without restarting
+    LIVE_KEYS = ('channel_map', 'relay_service_messages')
+
+    @classmethod
+    def init_connection(cls, conf):
+        build_router(conf)
+        relay = cls(conf)
+        relay.start()
+        return relay
+
+    @classmethod
+    def reconfigure(cls, conf, new):
+        """Apply `new` settings to the running connection for `conf`
+
+        Returns False without changing anything if a restart is needed
+        """
+        if changed_keys(conf, new) - set(cls.LIVE_KEYS):
+            return False
+        update_conf(conf, new)
+        relay = _relays.get(conf['name'])
+        if relay is not None:
+            d = relay.resolve_rooms()
+            d.addErrback(relay._reresolve_failed)
+        return True
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.api = MatrixAPI(conf)
+        self.backoff = Backoff(conf)
+        self.user_id = u'@{0}:{1}'.format(conf['sender_localpart'], conf['server_name'])
+        self.puppet_prefix = u'@' + conf.get('puppet_prefix', '_chatrelay_')
+
+        # room ID -> channel_map key, and alias or ID -> room ID
+        self.rooms = {}
+        self.room_ids = {}
+        size = conf.get('puppet_cache_size', 5000)
+        # puppet user ID -> display name set, and (user ID, room ID) joined
+        self.puppets = LRUCache(size)
+        self.joined = LRUCache(size)
+        self.seen_txns = LRUCache(1000)
+        self._txn = 0
+        self._port = None
+        self._retry = None
+        self.stopping = False
+
+    def start(self):
+        _relays[self.conf['name']] = self
+        site = Site(TransactionResource(self))
+        self._port = reactor.listenTCP(self.conf['listen_port'], site, interface=self.conf.get('listen_bind', '127.0.0.1'))
+        self._connect()
+
+    def _connect(self):
+        # the bot user must exist before anything else works
+        d = self._register(self.conf['sender_localpart'])
+        d.addCallback(lambda _: self.resolve_rooms())
+        d.addCallbacks(self._connected, self._connect_failed)
+
+    def _connected(self, _):
+        if self.stopping:
+            return
+        logger.info('{0} :: Connected to {1}'.format(self.conf['name'], self.conf['homeserver_url']))
+        self.backoff.connected()
+        register(self.conf['name'], self)
+
+    def _connect_failed(self, failure):
+        if self.stopping:
+            return
+        delay = self.backoff.next_delay()
+        logger.error('{0} :: Failed to connect to homeserver: {1}, retrying in {2}s'.format(
+            self.conf['name'], failure.getErrorMessage(), delay))
+        self._retry = reactor.callLater(delay, self._connect)
+
+    def stop(self):
+        """Stop listening and disconnect for good"""
+        self.stopping = True
+        unregister(self.conf['name'], self)
+        _relays.pop(self.conf['name'], None)
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        if self._port is not None:
+            self._port.stopListening()
+        self.api.close()
+
+    def resolve_rooms(self):
+        """Look up the room IDs of channel_map keys, Deferred fires once all are known"""
+        rooms = {}
+        ds = []
+        for key in self.conf['channel_map']:
+            d = self.room_id(key)
+            d.addCallbacks(self._resolved, self._resolve_failed, callbackArgs=(key, rooms), errbackArgs=(key,))
+            ds.append(d)
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addCallback(lambda _: setattr(self, 'rooms', rooms))
+        d.addErrback(lambda failure: failure.value.subFailure if failure.check(defer.FirstError) else failure)
+        return d
+
+    def _resolved(self, room_id, key, rooms):
+        rooms[room_id] = key
+        if recorder.enabled:
+            recorder.record_name(self.conf['name'], 'channel', room_id, key)
+
+    def _resolve_failed(self, failure, key):
+        logger.error(u'{0} :: Failed to resolve room {1}: {2}'.format(self.conf['name'], key, failure.getErrorMessage()))
+        return failure
+
+    def _reresolve_failed(self, failure):
+        logger.warn('{0} :: Keeping the previous room mapping'.format(self.conf['name']))
+
+    def room_id(self, room):
+        """Returns a Deferred firing with the ID of a room given its alias or ID"""
+        if room.startswith('!'):
+            return defer.succeed(room)
+        try:
+            return defer.succeed(self.room_ids[room])
+        except KeyError:
+            d = self.api.call('GET', '/directory/room/' + quote(room, safe=''))
+            d.addCallback(self._alias_resolved, room)
+            return d
+
+    def _alias_resolved(self, res, room):
+        self.room_ids[room] = res['room_id']
+        return res['room_id']
+
+    def _register(self, localpart):
+        d = self.api.call('POST', '/register', {'type': 'm.login.application_service', 'username': localpart})
+        d.addErrback(self._register_failed)
+        return d
+
+    def _register_failed(self, failure):
+        if errcode(failure) != 'M_USER_IN_USE':
+            return failure
+
+    def transaction(self, txn_id, body):
+        """Handle a transaction of events pushed by the homeserver
+
+        Homeservers retry transactions until acknowledged, so repeats are ignored
+        """
+        if txn_id in self.seen_txns:
+            return
+        self.seen_txns[txn_id] = True
+        for event in body.get('events', []):
+            if recorder.enabled:
+                recorder.record(self.conf['name'], 'event', json.dumps(event))
+            try:
+                self.event(event)
+            except Exception:
+                logger.exception('{0} :: Failed to handle event'.format(self.conf['name']))
+
+    def event(self, event):
+        name = self.conf['name']
+        trace.debug(u'%s <= %s', name, event)
+        received = time() if metrics.enabled else None
+        if metrics.enabled:
+            metrics.inc('inbound_messages', name)
+        if event.get('type') != 'm.room.message':
+            return
+        sender = event.get('sender', '')
+        if sender == self.user_id or sender.startswith(self.puppet_prefix):
+            # our own messages
+            return
+        chan = self.rooms.get(event.get('room_id'))
+        if chan is None:
+            return
+        content = event.get('content', {})
+        text = content.get('body')
+        if not text or content.get('msgtype') not in ('m.text', 'm.emote', 'm.notice'):
+            return
+        if content['msgtype'] == 'm.emote':
+            text = u'* ' + text
+        nick = sender[1:].split(':', 1)[0]
+        route(name, chan, text, nick, received=received)
+
+    def relay_message(self, destchan, message, fromnick=None, fromserver=None):
+        if not self.conf.get('relay_service_messages', True) and not fromnick:
+            logger.debug('%s :: Ignoring service message', self.conf['name'])
+            return
+        trace.debug(u'%s => %s from %s :%s', self.conf['name'], destchan, fromnick, message)
+        return self._send(destchan, message, fromnick, fromserver)
+
+    @defer.inlineCallbacks
+    def _send(self, destchan, message, fromnick, fromserver):
+        room_id = yield self.room_id(destchan)
+        if fromnick:
+            user_id = yield self.puppet(fromnick, fromserver)
+            content = {'msgtype': 'm.text', 'body': message}
+        else:
+            user_id = self.user_id
+            content = {'msgtype': 'm.notice', 'body': message}
+        if (user_id, room_id) not in self.joined:
+            yield self.api.call('POST', '/join/' + quote(room_id, safe=''), {}, user_id)
+            self.joined[(user_id, room_id)] = True
+        self._txn += 1
+        path = '/rooms/{0}/send/m.room.message/{1}.{2}'.format(quote(room_id, safe=''), int(time() * 1000), self._txn)
+        yield self.api.call('PUT', path, content, user_id)
+
+    @defer.inlineCallbacks
+    def puppet(self, fromnick, fromserver):
+        """Returns a Deferred firing with the user ID to send as for a relayed sender,
+        registering it on first use
+        """
+        localpart = puppet_localpart(self.puppet_prefix[1:], fromnick, fromserver)
+        user_id = u'@{0}:{1}'.format(localpart, self.conf['server_name'])
+        if self.puppets.get(user_id) != fromnick:
+            yield self._register(localpart)
+            yield self.api.call('PUT', '/profile/{0}/displayname'.format(quote(user_id, safe='')),
+                                {'displayname': fromnick}, user_id)
+            self.puppets[user_id] = fromnick
+        defer.returnValue(user_id)
+
+    def sizes(self):
+        return {'puppets': len(self.puppets), 'joined': len(self.joined), 'rooms': len(self.rooms)}
+
+
+# running relays by name, for reconfigure()
+_relays = {}
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from time import time
+import re
+
+# mIRC formatting codes
+_format_re = re.compile(u'\x03[0-9]{0,2}(?:,[0-9]{1,2})?|[\x02\x0f\x16\x1d\x1f]')
+
+# text as relayed by the irc protocol, "<nick> message"
+_relayed_re = re.compile(r'^<([^>\s]{1,64})> (.*)$', re.DOTALL)
+
+class DedupCache(object):
+    """Short lived fingerprints of messages seen in or relayed to each channel
+
+    A fingerprint is (server, channel, sender, text), with sender and text
+    normalized so the same message relayed along different paths compares
+    equal. Each is stored with its source, the channel and unnormalized sender
+    it came from. A message arriving in a channel we relayed it to from
+    elsewhere is an echo, one arriving again from another source (such as a
+    bridge bot reposting it) is a duplicate, and so is one that would be
+    relayed somewhere it already reached by another path. The same sender
+    repeating themselves in the same channel is neither. Fingerprints are kept for `dedup_window` seconds, and at most
+    `dedup_size` of them.
+    """
+
+    def __init__(self):
+        self.window = 0
+        self.maxsize = 0
+        self._seen = OrderedDict()
+        self._suffix_re = None
+        self.suppressed = 0
+        self.skipped = 0
+
+    def configure(self, conf):
+        self.window = conf.get('dedup_window', 10)
+        self.maxsize = conf.get('dedup_size', 10000)
+        names = sorted((re.escape(s['name']) for s in conf['servers']), key=len, reverse=True)
+        # strip nick disambiguation done by relay_message(), e.g. bob_slack__
+        self._suffix_re = re.compile('(?:_(?:{0}))?_*$'.format('|'.join(names)))
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def fingerprint(self, fromnick, message):
+        text = _format_re.sub(u'', message)
+        match = _relayed_re.match(text)
+        if match is not None:
+            fromnick, text = match.groups()
+        sender = self._suffix_re.sub(u'', (fromnick or u'').lower())
+        return sender, u' '.join(text.split()).lower()
+
+    def source(self, server, chan, fromnick):
+        """Where a message was received, see check()"""
+        return server, chan.lower() if chan else None, (fromnick or u'').lower()
+
+    def check(self, server, chan, fp, source):
+        """Record `fp` in server/chan and return whether it was already there
+        from a different source
+        """
+        now = time()
+        self._expire(now)
+        key = (server, chan.lower()) + fp
+        entry = self._seen.pop(key, None)
+        if entry is not None and entry[1] != source:
+            self._seen[key] = entry
+            return True
+        self._seen[key] = (now, source)
+        return False
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        seen = self._seen
+        while seen:
+            key, entry = next(iter(seen.items()))
+            if entry[0] >= cutoff and len(seen) < self.maxsize:
+                break
+            del seen[key]
+
+
+cache = DedupCache()
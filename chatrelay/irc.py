@@ -1,6 +1,9 @@
-from . import servers, TextProto, BasicFactory, tostr
+from . import servers, route, register, unregister, announce, metrics, recorder, trace, TextProto, BasicFactory, LRUCache, changed_keys, tostr, build_router
+from .outbound import TokenBucket
+from collections import OrderedDict, deque
+from twisted.internet import reactor, ssl, defer
+from twisted.internet.task import LoopingCall
 from time import time as _time
-import collections
 import logging
 import random
 import re
@@ -10,11 +13,37 @@ logger = logging.getLogger('chatrelay')
 def time():
     return int(_time())
 
+_color_re = re.compile(r'\\x03[0-9]{1,2}')
+
 def stripcolor(text):
-    return re.sub(r'\\x03[0-9]{1,2}', '', text)
+    return _color_re.sub('', text)
+
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def _unescape_tag(value):
+    if '\\' not in value:
+        return value
+    ret = []
+    i = 0
+    end = len(value)
+    while i < end:
+        ch = value[i]
+        if ch == '\\':
+            i += 1
+            if i < end:
+                ret.append(_tag_escapes.get(value[i], value[i]))
+        else:
+            ret.append(ch)
+        i += 1
+    return ''.join(ret)
 
 class IRCLine(object):
-    """Represents a parsed IRC line, both server and client protocols"""
+    """Represents a parsed IRC line, both server and client protocols
+
+    The IRCv3 tags and the prefix handle are only parsed when first accessed
+    """
+
+    __slots__ = ('prefix', 'cmd', 'args', 'text', 'raw', 'received', '_handle', '_tags_raw', '_tags')
 
     def __init__(self):
         self.prefix = None
@@ -22,33 +51,57 @@ class IRCLine(object):
         self.args = []
         self.text = ''
         self.raw = None
-        self.handle = HandleInfo()
+        self.received = None
+        self._handle = None
+        self._tags_raw = None
+        self._tags = None
 
     @classmethod
     def parse(cls, line):
         ret = cls()
         ret.raw = line
-        tokens = collections.deque(line.strip().split(' '))
-        if tokens[0][0:1] == ':':
-            ret.prefix = tokens.popleft()[1:]
-            ret.handle = HandleInfo.parse(ret.prefix)
-        ret.cmd = tokens.popleft()
-        text_words = []
-        ontext = False
-        for token in tokens:
-            if not ontext:
-                if token.strip() == '':
-                    continue
-                if token.lstrip()[0:1] == ':':
-                    ontext = True
-                    text_words.append(token.lstrip()[1:])
-                else:
-                    ret.args.append(token.strip())
+        line = line.lstrip(' ')
+        if line[:1] == '@':
+            tags, _, line = line.partition(' ')
+            ret._tags_raw = tags[1:]
+            line = line.lstrip(' ')
+        if line[:1] == ':':
+            prefix, _, line = line.partition(' ')
+            ret.prefix = prefix[1:]
+            line = line.lstrip(' ')
+        cmd, sep, params = line.partition(' ')
+        ret.cmd = cmd.rstrip()
+        if sep:
+            # the trailing parameter is kept exactly as sent
+            if params[:1] == ':':
+                ret.text = params[1:]
             else:
-                text_words.append(token)
-        ret.text = ' '.join(text_words)
+                middle, sep, text = params.partition(' :')
+                ret.args = middle.split()
+                if sep:
+                    ret.text = text
         return ret
 
+    @property
+    def handle(self):
+        if self._handle is None:
+            if self.prefix is None:
+                self._handle = HandleInfo()
+            else:
+                self._handle = HandleInfo.parse(self.prefix)
+        return self._handle
+
+    @property
+    def tags(self):
+        """IRCv3 message tags as a dict, valueless tags map to None"""
+        if self._tags is None:
+            self._tags = {}
+            if self._tags_raw:
+                for tag in self._tags_raw.split(';'):
+                    key, sep, value = tag.partition('=')
+                    self._tags[key] = _unescape_tag(value) if sep else None
+        return self._tags
+
     def __str__(self):
         if self.raw is None:
             ret = []
@@ -65,6 +118,8 @@ class IRCLine(object):
 class HandleInfo(object):
     """Represents an IRC client handle"""
 
+    __slots__ = ('nick', 'user', 'host')
+
     def __init__(self):
         self.nick = None
         self.user = None
@@ -72,71 +127,132 @@ class HandleInfo(object):
 
     @classmethod
     def parse(cls, handle):
-        match = re.search(r'^([^!]+)!([^@]+)@(.+)$', handle.strip())
         ret = cls()
-        if match is not None:
-            ret.nick = match.group(1)
-            ret.user = match.group(2)
-            ret.host = match.group(3)
+        nick, sep, rest = handle.strip().partition('!')
+        if nick and sep:
+            user, sep, host = rest.partition('@')
+            if user and sep and host:
+                ret.nick = nick
+                ret.user = user
+                ret.host = host
         return ret
 
     def __str__(self):
-        return '{nick}!{user}@{host}'.format(**self.__dict__)
+        return '{0}!{1}@{2}'.format(self.nick, self.user, self.host)
+
+
+def parse_line(name, raw_line):
+    """Decode, log and parse a line received by the `name` connection"""
+    raw_line = tostr(raw_line)
+    trace.debug(u'%s <= %s', name, raw_line)
+    if recorder.enabled:
+        recorder.record(name, 'line', raw_line)
+    if not metrics.enabled:
+        return IRCLine.parse(raw_line)
+    start = _time()
+    line = IRCLine.parse(raw_line)
+    line.received = start
+    metrics.observe('parse', name, _time() - start)
+    metrics.inc('inbound_messages', name)
+    metrics.inc('inbound_bytes', name, len(raw_line))
+    return line
+
+
+mirc_colors = ['02','03','04','05','06','07','08','09','10','11','12','13']
+
+def prefix_nick(conf, nickcolor, message, fromnick):
+    """Prepend the sender to a relayed message, in a random color with `nick_colors`"""
+    if conf.get('nick_colors'):
+        color = nickcolor.get(fromnick)
+        if color is None:
+            color = nickcolor[fromnick] = random.choice(mirc_colors)
+        nick = '\x03{0}{1}\x03'.format(color, fromnick)
+    else:
+        nick = fromnick
+    return '<{0}> {1}'.format(nick, message)
 
 
 class IRC(TextProto):
     """IRC client protocol"""
 
-    mirc_colors = ['02','03','04','05','06','07','08','09','10','11','12','13']
+    mirc_colors = mirc_colors
 
     def __init__(self, conf):
         self.conf = conf
-        self.nickcolor = {}
+        self.nick = conf.get('nick')
+        self.nickcolor = LRUCache(conf.get('nick_color_cache', 1000))
 
     def lineReceived(self, raw_line):
-        raw_line = tostr(raw_line)
-        logger.debug("{0} <= {1}".format(self.conf['name'], raw_line))
-        line = IRCLine.parse(raw_line)
+        line = parse_line(self.conf['name'], raw_line)
         if line.cmd == '001':
-            nsp = self.conf.get('nickserv_pass')
-            if nsp:
-                self.sendLine(u'PRIVMSG NickServ :IDENTIFY {0}'.format(nsp))
-            for chan in self.conf['join_channels']:
-                self.sendLine(u'JOIN {0}'.format(chan))
+            self.registered()
         elif line.cmd == 'PING':
             self.sendLine(u'PONG :{0}'.format(line.text))
-        elif line.cmd == 'PRIVMSG':
+        elif line.cmd == 'PRIVMSG' and line.args:
             # do relay
-            for mychan, map in self.conf['channel_map'].items():
-                if mychan in line.args:
-                    for dest, destchan in map.items():
-                        mtext = stripcolor(line.text)
-                        servers[dest].relay_message(destchan, mtext, line.handle.nick, self.conf['name'])
+            route(self.conf['name'], line.args[0], line.text, line.handle.nick, stripcolor, line.received)
+
+    def registered(self):
+        self.join_channels()
+        # JOINs go out first, then anything held for this connection
+        register(self.conf['name'], self)
+
+    def join_channels(self):
+        nsp = self.conf.get('nickserv_pass')
+        if nsp:
+            self.sendLine(u'PRIVMSG NickServ :IDENTIFY {0}'.format(nsp))
+        self.sendLines(u'JOIN {0}'.format(chan) for chan in self.conf['join_channels'])
 
     def connectionMade(self):
         logger.info(u'{name} :: Connected'.format(**self.conf))
         self.sendLine(u'PASS {pass}'.format(**self.conf))
-        self.sendLine(u'NICK {nick}'.format(**self.conf))
+        self.sendLine(u'NICK {0}'.format(self.nick))
         self.sendLine(u'USER {user} {vhost} {host} :{realname}'.format(**self.conf))
+        self.start_keepalive()
+
+    def send_ping(self):
+        self.sendLine(u'PING :{0}'.format(self.nick))
 
     def relay_message(self, destchan, message, fromnick=None, fromserver=None):
         if fromnick:
-            if self.conf.get('nick_colors'):
-                color = self.nickcolor.setdefault(fromnick, random.choice(IRC.mirc_colors))
-                nick = '\x03{0}{1}\x03'.format(color, fromnick)
-            else:
-                nick = fromnick
-            message = '<{0}> {1}'.format(nick, message)
+            message = prefix_nick(self.conf, self.nickcolor, message, fromnick)
         self.sendLine(u'PRIVMSG {0} :{1}'.format(destchan, message))
 
+    def rejoin(self, old_channels):
+        """JOIN and PART to match join_channels after it changed from `old_channels`"""
+        channels = self.conf['join_channels']
+        self.sendLines(u'PART {0}'.format(chan) for chan in old_channels if chan not in channels)
+        self.sendLines(u'JOIN {0}'.format(chan) for chan in channels if chan not in old_channels)
+
+    def sizes(self):
+        return {'nick_colors': len(self.nickcolor)}
+
 
 class UnrealServ(TextProto):
     """IRC server/services protocol - only tested with UnrealIRCd"""
 
     def __init__(self, conf):
         self.conf = conf
-        self.remote_nicks = set()
-        self.nicks = {}
+        # users on the rest of the network, lowercase nick -> UID (None if not
+        # known) and UID -> nick
+        self.remote_nicks = {}
+        self.remote_uids = {}
+        # memoized (fromserver, fromnick) -> disambiguated pseudo-user nick
+        self._display_names = LRUCache(conf.get('pseudo_user_max', 500) * 2)
+        # our relay pseudo-users, lowercase nick -> [uid, last used], least
+        # recently used first
+        self.nicks = OrderedDict()
+        self.handle_uid = self.conf['sid'] + ('0' * 6)
+        self.max_pseudo_users = conf.get('pseudo_user_max', 500)
+        self.pseudo_user_idle = conf.get('pseudo_user_idle', 3600)
+        self._next_uid = 1
+        self._free_uids = []
+        self._reaper = None
+        self.synced = False
+        # servers on the rest of the network, SID -> [name, SID of the
+        # server it is linked through]
+        self.remote_servers = {}
+        self._uplink_sid = None
 
     def connectionMade(self):
         logger.info('{name} :: Connected'.format(**self.conf))
@@ -145,51 +261,523 @@ class UnrealServ(TextProto):
         self.sendLine(u'PROTOCTL NOQUIT NICKv2 SJOIN SJ3 CLK TKLEXT TKLEXT2 NICKIP ESVID MLOCK EXTSWHOIS')
         self.sendLine(u'SERVER {vhost} 1 :{desc}'.format(**self.conf))
 
-        uid = self.conf['sid'] + ('0' * 6)
+        uid = self.handle_uid
         self.sendLine(u':{0} UID {nick} 0 {1} {user} {2} {3} 0 {mode} * * :{realname}'.format(
             self.conf['sid'], time(), self.conf['vhost'], uid, **self.conf['handle']))
-        self.nicks[self.conf['handle']['nick'].lower()] = uid
-        for chan in self.conf['handle']['join_channels']:
-            self.sendLine(u':{0} SJOIN {1} {2} :{3}'.format(self.conf['sid'], time(), chan, uid))
+        self.sendLines(u':{0} SJOIN {1} {2} :{3}'.format(self.conf['sid'], time(), chan, uid)
+                       for chan in self.conf['handle']['join_channels'])
 
         self.sendLine('EOS')
+        self.start_keepalive()
+        if self.pseudo_user_idle:
+            self._reaper = LoopingCall(self._retire_idle)
+            self._reaper.start(min(60, self.pseudo_user_idle), now=False)
+
+    def connectionLost(self, reason):
+        if self._reaper is not None and self._reaper.running:
+            self._reaper.stop()
+        TextProto.connectionLost(self, reason)
+
+    def send_ping(self):
+        self.sendLine(u':{sid} PING :{vhost}'.format(**self.conf))
+
+    def rejoin(self, old_channels):
+        """Join and part the handle to match its join_channels after it changed from `old_channels`"""
+        uid = self.handle_uid
+        channels = self.conf['handle']['join_channels']
+        self.sendLines(u':{0} PART {1}'.format(uid, chan) for chan in old_channels if chan not in channels)
+        self.sendLines(u':{0} SJOIN {1} {2} :{3}'.format(self.conf['sid'], time(), chan, uid)
+                       for chan in channels if chan not in old_channels)
 
     def lineReceived(self, raw_line):
-        raw_line = tostr(raw_line)
-        logger.debug("{0} <= {1}".format(self.conf['name'], raw_line))
-        line = IRCLine.parse(raw_line)
+        line = parse_line(self.conf['name'], raw_line)
         if line.cmd == 'PING':
             self.sendLine(u':{0} PONG {1} :{2}'.format(self.conf['sid'], self.conf['vhost'], line.text))
         elif line.cmd == 'UID':
-            self.remote_nicks.add(line.args[0].lower())
-        elif line.cmd == 'PRIVMSG':
+            self._remote_add(line.args[0], line.args[5] if len(line.args) > 5 else None)
+        elif line.cmd == 'NICK' and line.args:
+            if len(line.args) > 2:
+                # NICKv2 introduction of a new user
+                self._remote_add(line.args[0])
+            elif line.prefix:
+                self._remote_rename(line.prefix, line.args[0])
+        elif line.cmd == 'QUIT' and line.prefix:
+            self._remote_remove(line.prefix)
+        elif line.cmd == 'KILL' and line.args:
+            self._killed(line.args[0])
+        elif line.cmd == 'PROTOCTL':
+            for arg in line.args:
+                if arg.startswith('SID='):
+                    self._uplink_sid = arg[4:]
+        elif line.cmd == 'SERVER' and line.args and not line.prefix:
+            # our uplink, introduced by SID in PROTOCTL
+            if self._uplink_sid:
+                self.remote_servers[self._uplink_sid] = [line.args[0], None]
+        elif line.cmd == 'SID' and len(line.args) > 2:
+            self.remote_servers[line.args[2]] = [line.args[0], self._server_sid(line.prefix)]
+        elif line.cmd == 'SQUIT' and line.args:
+            self._split(line.args[0])
+        elif line.cmd == 'EOS' and not self.synced:
+            # the uplink accepted the link and finished its burst
+            self.synced = True
+            register(self.conf['name'], self)
+        elif line.cmd == 'PRIVMSG' and line.args:
             # do relay
-            for mychan, map in self.conf['channel_map'].items():
-                if mychan in line.args:
-                    for dest, destchan in map.items():
-                        mtext = stripcolor(line.text)
-                        servers[dest].relay_message(destchan, mtext, line.prefix, self.conf['name'])
+            fromnick = self.remote_uids.get(line.prefix, line.prefix)
+            route(self.conf['name'], line.args[0], line.text, fromnick, stripcolor, line.received)
+
+    def _remote_add(self, nick, uid=None):
+        self.remote_nicks[nick.lower()] = uid
+        if uid:
+            self.remote_uids[uid] = nick
+
+    def _remote_uid(self, source):
+        """Returns the UID for a UID or nick message source, or None"""
+        if source in self.remote_uids:
+            return source
+        return self.remote_nicks.get(source.lower())
+
+    def _remote_rename(self, source, newnick):
+        uid = self._remote_uid(source)
+        self.remote_nicks.pop(self.remote_uids.get(uid, source).lower(), None)
+        self.remote_nicks[newnick.lower()] = uid
+        if uid:
+            self.remote_uids[uid] = newnick
+
+    def _remote_remove(self, source):
+        uid = self._remote_uid(source)
+        self.remote_nicks.pop(self.remote_uids.pop(uid, source).lower(), None)
+
+    def _server_sid(self, server):
+        """Returns the SID for a SID or server name, or None"""
+        if server in self.remote_servers:
+            return server
+        for sid, entry in self.remote_servers.items():
+            if entry[0].lower() == server.lower():
+                return sid
+        return None
+
+    def _split(self, server):
+        # with NOQUIT, users behind a lost server get no QUITs, so forget every
+        # user on it and on the servers behind it
+        sid = self._server_sid(server)
+        if sid is None:
+            return
+        lost = set([sid])
+        while True:
+            behind = set(s for s, entry in self.remote_servers.items() if entry[1] in lost) - lost
+            if not behind:
+                break
+            lost |= behind
+        for s in lost:
+            del self.remote_servers[s]
+        for uid in [uid for uid in self.remote_uids if uid[:3] in lost]:
+            self._remote_remove(uid)
+        logger.info('{0} :: {1} split from the network, forgot {2} servers'.format(self.conf['name'], server, len(lost)))
+
+    def _killed(self, target):
+        # one of our pseudo-users may have been killed, forget it so it gets
+        # reintroduced when needed
+        for key, entry in self.nicks.items():
+            if entry[0] == target or key == target.lower():
+                del self.nicks[key]
+                self._free_uids.append(entry[0])
+                return
+        self._remote_remove(target)
+
+    def _new_uid(self):
+        if self._free_uids:
+            return self._free_uids.pop()
+        uid = self.conf['sid'] + str(self._next_uid).zfill(6)
+        self._next_uid += 1
+        return uid
+
+    def _introduce(self, fromnick):
+        if len(self.nicks) >= self.max_pseudo_users:
+            self._retire(next(iter(self.nicks)), 'Too many relay users')
+        uid = self._new_uid()
+        self.sendLine(u':{sid} UID {0} 0 {1} {0} {vhost} {2} 0 +i * * :{0}'.format(
+            fromnick, time(), uid, **self.conf))
+        return uid
+
+    def _retire(self, key, reason):
+        uid = self.nicks.pop(key)[0]
+        self.sendLine(u':{0} QUIT :{1}'.format(uid, reason))
+        self._free_uids.append(uid)
+
+    def _retire_idle(self):
+        cutoff = time() - self.pseudo_user_idle
+        while self.nicks:
+            key, entry = next(iter(self.nicks.items()))
+            if entry[1] > cutoff:
+                break
+            self._retire(key, 'Idle')
+
+    def _nick_taken(self, nick):
+        nick = nick.lower()
+        return nick in self.remote_nicks or nick == self.conf['handle']['nick'].lower()
+
+    def _display_name(self, fromnick, fromserver):
+        """Pseudo-user nick for a relayed sender, avoiding nicks already on the network"""
+        key = (fromserver, fromnick)
+        nick = self._display_names.get(key)
+        if nick is None or self._nick_taken(nick):
+            nick = fromnick
+            if fromserver and self._nick_taken(nick):
+                nick += '_'+fromserver
+            while self._nick_taken(nick):
+                nick += '_'
+            self._display_names[key] = nick
+        return nick
 
     def relay_message(self, destchan, message, fromnick=None, fromserver=None):
         if fromnick:
-            if fromserver and fromnick.lower() in self.remote_nicks:
-                fromnick += '_'+fromserver
-            while fromnick.lower() in self.remote_nicks:
-                fromnick += '_'
-            if fromnick.lower() not in self.nicks:
-                uid = self.conf['sid'] + str(len(self.nicks)).zfill(6)
-                self.sendLine(u':{sid} UID {0} 0 {1} {0} {vhost} {2} 0 +i * * :{0}'.format(
-                    fromnick, time(), uid, **self.conf))
-                self.nicks[fromnick.lower()] = uid
+            fromnick = self._display_name(fromnick, fromserver)
+            key = fromnick.lower()
+            entry = self.nicks.pop(key, None)
+            uid = self._introduce(fromnick) if entry is None else entry[0]
+            self.nicks[key] = [uid, time()]
         else:
-            fromnick = self.conf['handle']['nick']
-        uid = self.nicks[fromnick.lower()]
+            uid = self.handle_uid
         self.sendLine(u':{0} PRIVMSG {1} :{2}'.format(uid, destchan, message))
 
+    def sizes(self):
+        return {
+            'pseudo_users': len(self.nicks),
+            'remote_nicks': len(self.remote_nicks),
+            'remote_servers': len(self.remote_servers),
+            'free_uids': len(self._free_uids),
+        }
+
+
+_nick_re = re.compile(r'[^A-Za-z0-9\[\]\\`_^{|}-]')
+
+class PoolIRC(IRC):
+    """IRC client protocol for one connection of an IRCPool"""
+
+    def __init__(self, conf, link):
+        IRC.__init__(self, conf)
+        self.link = link
+        self.nick = link.nick
+
+    def lineReceived(self, raw_line):
+        if self.link.primary:
+            line = parse_line(self.conf['name'], raw_line)
+        else:
+            # only the primary connection relays or records anything
+            line = IRCLine.parse(tostr(raw_line))
+        if line.cmd == '001':
+            self.registered()
+        elif line.cmd == '433':
+            # nick in use
+            self.nick = self.link.nick = self.nick + '_'
+            self.sendLine(u'NICK {0}'.format(self.nick))
+        elif line.cmd == 'PING':
+            self.sendLine(u'PONG :{0}'.format(line.text))
+        elif line.cmd == 'PRIVMSG' and line.args and self.link.primary:
+            if not self.link.pool.is_ours(line.handle.nick):
+                route(self.conf['name'], line.args[0], line.text, line.handle.nick, stripcolor, line.received)
+
+    def registered(self):
+        if self.link.puppet is None:
+            self.join_channels()
+        self.link.registered(self)
+
+    def connectionLost(self, reason):
+        IRC.connectionLost(self, reason)
+        self.link.lost(self)
+
+
+class PoolLink(BasicFactory):
+    """One client connection of an IRCPool, relayed lines are paced to stay under
+    the server's flood limit, `pool_link_rate` lines per second with bursts of
+    `pool_link_burst`
+    """
+
+    def __init__(self, pool, nick, primary=False, puppet=None):
+        BasicFactory.__init__(self, pool.conf)
+        self.pool = pool
+        self.nick = nick
+        self.primary = primary
+        # (fromserver, fromnick) relayed as this nick, None for a shared connection
+        self.puppet = puppet
+        self.proto = None
+        self.ready = False
+        self.joined = set()
+        self.last_used = time()
+        # [destchan, message, fromnick, Deferred] waiting to be sent
+        self.lines = deque()
+        self.bucket = TokenBucket(self.conf.get('pool_link_rate', 1), self.conf.get('pool_link_burst', 5))
+        self._call = None
+
+    def connect(self):
+        conf = self.conf
+        if conf['ssl']:
+            self.connector = reactor.connectSSL(conf['host'], conf['port'], self, ssl.ClientContextFactory())
+        else:
+            self.connector = reactor.connectTCP(conf['host'], conf['port'], self)
+
+    def buildProtocol(self, addr):
+        self.backoff.connected()
+        return PoolIRC(self.conf, self)
+
+    def registered(self, proto):
+        self.proto = proto
+        self.ready = True
+        self.pool.link_up(self)
+        self._schedule(0)
+
+    def lost(self, proto):
+        self.proto = None
+        self.ready = False
+        self.joined.clear()
+        self.pool.link_down(self)
+
+    def stop(self, reason=None):
+        """Disconnect for good"""
+        self.stopping = True
+        if self._reconnect is not None and self._reconnect.active():
+            self._reconnect.cancel()
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        if reason and self.proto is not None:
+            self.proto.sendLine(u'QUIT :{0}'.format(reason))
+            self.proto.flush()
+        if self.connector is not None:
+            self.connector.disconnect()
+
+    def _retry(self, connector, what):
+        if self.stopping:
+            return
+        if self.puppet is not None:
+            # puppets are only brought back when their sender speaks again
+            self.stopping = True
+            self.pool.puppet_failed(self)
+            return
+        name = self.conf['name']
+        delay = self.backoff.next_delay()
+        if self.primary:
+            announce(name, '{0} {1}, retrying in {2}s'.format(what, name, delay))
+        logger.info('{0} :: Pool connection {1} retrying in {2}s'.format(name, self.nick, delay))
+        self._reconnect = reactor.callLater(delay, connector.connect)
+
+    def send(self, destchan, message, fromnick):
+        """Returns a Deferred firing once the message has been written"""
+        d = defer.Deferred()
+        self.lines.append([destchan, message, fromnick, d])
+        self.last_used = time()
+        self._schedule(0)
+        return d
+
+    def _schedule(self, delay):
+        if self._call is None and self.ready:
+            self._call = reactor.callLater(delay, self._drain)
+
+    def _drain(self):
+        self._call = None
+        while self.lines and self.ready:
+            delay = self.bucket.take()
+            if delay:
+                self._schedule(delay)
+                return
+            destchan, message, fromnick, d = self.lines.popleft()
+            if self.puppet is not None:
+                if destchan.lower() not in self.joined:
+                    self.joined.add(destchan.lower())
+                    self.proto.sendLine(u'JOIN {0}'.format(destchan))
+            elif fromnick:
+                message = prefix_nick(self.conf, self.pool.nickcolor, message, fromnick)
+            self.proto.sendLine(u'PRIVMSG {0} :{1}'.format(destchan, message))
+            d.callback(None)
+
+
+class IRCPool(object):
+    """Several client connections to one IRC server, registered as a single connection
+
+    Each of the `pool_size` shared connections takes its share of the mapped
+    channels, so more lines can be sent before hitting the server's per-client
+    flood limits. A channel sticks to its connection to keep messages in order,
+    and is moved to the least busy one after `pool_reassign_idle` seconds
+    without messages. Only the first connection relays what it receives.
+
+    With `pool_puppets`, messages from each remote sender are sent by a
+    connection of their own using their nick, up to `pool_puppet_max` of them,
+    closed after `pool_puppet_idle` seconds without messages.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.nickcolor = LRUCache(conf.get('nick_color_cache', 1000))
+        nick = conf['nick']
+        self.links = [PoolLink(self, nick, primary=True)]
+        self.links.extend(PoolLink(self, u'{0}{1}'.format(nick, i)) for i in range(1, conf['pool_size']))
+        # lowercase channel -> [PoolLink, last used]
+        self.channels = {}
+        # (fromserver, fromnick) -> PoolLink, least recently used first
+        self.puppets = OrderedDict()
+        self.stopping = False
+        self._puppets_paused = 0
+        self._reaper = None
+
+    def start(self):
+        for link in self.links:
+            link.connect()
+        if self.conf.get('pool_puppets'):
+            self._reaper = LoopingCall(self._retire_idle)
+            self._reaper.start(min(60, self.conf.get('pool_puppet_idle', 1800)), now=False)
+
+    def stop(self):
+        """Disconnect every connection for good"""
+        self.stopping = True
+        unregister(self.conf['name'], self)
+        if self._reaper is not None and self._reaper.running:
+            self._reaper.stop()
+        for link in self.links + list(self.puppets.values()):
+            link.stop()
+
+    def link_up(self, link):
+        if link.puppet is None and servers.get(self.conf['name']) is not self:
+            register(self.conf['name'], self)
+
+    def link_down(self, link):
+        up = [l for l in self.links if l.ready]
+        if not up and not self.stopping:
+            unregister(self.conf['name'], self)
+        self._hand_over(link)
+
+    def _hand_over(self, link):
+        """Send whatever `link` still had waiting with the shared connections"""
+        pending = link.lines
+        link.lines = deque()
+        up = any(l.ready for l in self.links)
+        for destchan, message, fromnick, d in pending:
+            if up:
+                self.link_for(destchan).send(destchan, message, fromnick).chainDeferred(d)
+            else:
+                d.errback(RuntimeError('Connection to {0} lost'.format(self.conf['host'])))
+
+    def is_ours(self, nick):
+        nick = nick.lower()
+        return any(link.nick.lower() == nick for link in self.links + list(self.puppets.values()))
+
+    def link_for(self, destchan):
+        """The shared connection to send to `destchan` with"""
+        key = destchan.lower()
+        now = time()
+        entry = self.channels.get(key)
+        if entry is None or not entry[0].ready or now - entry[1] > self.conf.get('pool_reassign_idle', 60):
+            up = [link for link in self.links if link.ready]
+            link = min(up, key=lambda l: (len(l.lines), self._active_channels(l, now)))
+            entry = self.channels[key] = [link, now]
+        else:
+            entry[1] = now
+        return entry[0]
+
+    def _active_channels(self, link, now):
+        idle = self.conf.get('pool_reassign_idle', 60)
+        return sum(1 for l, used in self.channels.values() if l is link and now - used <= idle)
+
+    def relay_message(self, destchan, message, fromnick=None, fromserver=None):
+        link = None
+        if fromnick and self.conf.get('pool_puppets') and time() >= self._puppets_paused:
+            link = self.puppet(fromnick, fromserver)
+        if link is None:
+            link = self.link_for(destchan)
+        return link.send(destchan, message, fromnick)
+
+    def puppet(self, fromnick, fromserver):
+        """The puppet connection for a sender, or None if there is no room for another"""
+        key = (fromserver, fromnick)
+        link = self.puppets.pop(key, None)
+        if link is None:
+            if len(self.puppets) >= self.conf.get('pool_puppet_max', 10):
+                oldest = next(iter(self.puppets.values()))
+                if oldest.lines or not oldest.ready:
+                    # every puppet is busy, don't thrash
+                    return None
+                self._retire(oldest.puppet, 'Too many relay users')
+            nick = _nick_re.sub('', fromnick)[:self.conf.get('pool_puppet_nicklen', 16)] or 'relay'
+            if nick[0] in '0123456789-':
+                nick = '_' + nick
+            link = PoolLink(self, nick + self.conf.get('pool_puppet_suffix', ''), puppet=key)
+            link.connect()
+        self.puppets[key] = link
+        return link
+
+    def puppet_failed(self, link):
+        """A puppet connection went away, its messages are sent by the shared connections"""
+        if self.puppets.get(link.puppet) is link:
+            del self.puppets[link.puppet]
+        if not link.backoff.connected_at:
+            # it never came up, stop trying puppets for a while
+            self._puppets_paused = time() + link.backoff.next_delay()
+            logger.warn('{0} :: Puppet connection failed, sending as the shared connections for now'.format(self.conf['name']))
+        self._hand_over(link)
+
+    def _retire(self, key, reason):
+        link = self.puppets.pop(key)
+        link.stop(reason)
+        self._hand_over(link)
+
+    def _retire_idle(self):
+        cutoff = time() - self.conf.get('pool_puppet_idle', 1800)
+        while self.puppets:
+            key, link = next(iter(self.puppets.items()))
+            if link.last_used > cutoff:
+                break
+            self._retire(key, 'Idle')
+
+    def rejoin(self, old_channels):
+        for link in self.links:
+            if link.proto is not None:
+                link.proto.rejoin(old_channels)
+
+    def sizes(self):
+        return {
+            'nick_colors': len(self.nickcolor),
+            'pool_connected': sum(1 for link in self.links if link.ready),
+            'pool_channels': len(self.channels),
+            'puppets': len(self.puppets),
+        }
+
 
 class IRCFactory(BasicFactory):
     protocol = IRC
+    LIVE_KEYS = ('channel_map', 'join_channels', 'nick_colors')
+
+    @classmethod
+    def init_connection(cls, conf):
+        if not conf.get('pool_size'):
+            return super(IRCFactory, cls).init_connection(conf)
+        build_router(conf)
+        pool = IRCPool(conf)
+        pool.start()
+        return pool
+
+    @classmethod
+    def reconfigure(cls, conf, new):
+        old_channels = list(conf['join_channels'])
+        if not super(IRCFactory, cls).reconfigure(conf, new):
+            return False
+        proto = servers.get(conf['name'])
+        if proto is not None:
+            proto.rejoin(old_channels)
+        return True
 
 
 class UnrealServFactory(BasicFactory):
     protocol = UnrealServ
+    LIVE_KEYS = ('channel_map', 'handle')
+
+    @classmethod
+    def reconfigure(cls, conf, new):
+        # only the handle's channels can change without reintroducing it
+        if changed_keys(conf['handle'], new.get('handle', {})) - set(['join_channels']):
+            return False
+        old_channels = list(conf['handle']['join_channels'])
+        if not super(UnrealServFactory, cls).reconfigure(conf, new):
+            return False
+        proto = servers.get(conf['name'])
+        if proto is not None:
+            proto.rejoin(old_channels)
+        return True
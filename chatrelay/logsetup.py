@@ -0,0 +1,63 @@
+from twisted.internet import reactor
+import logging
+import logging.handlers
+import random
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger('chatrelay')
+trace = logging.getLogger('chatrelay.trace')
+
+class SampleFilter(logging.Filter):
+    """Passes roughly `rate` of records, chosen at random"""
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        return random.random() < self.rate
+
+
+class ThreadQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a QueueListener thread without formatting them first
+
+    The stock QueueHandler formats in the calling thread so records can be
+    pickled, which isn't needed for an in-process queue
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure(conf):
+    """Set up the chatrelay logger from the log_* keys at the top level of the config"""
+    level = conf.get('log_level')
+    if not level:
+        return
+    level = getattr(logging, level)
+    logger.setLevel(level)
+
+    handlers = [logging.StreamHandler()]
+    if conf.get('log_file'):
+        handlers.append(logging.FileHandler(conf['log_file']))
+    for handler in handlers:
+        handler.setLevel(level)
+
+    sample = conf.get('log_trace_sample', 1.0)
+    if sample < 1.0:
+        trace.addFilter(SampleFilter(sample))
+
+    if not conf.get('log_async', True):
+        for handler in handlers:
+            logger.addHandler(handler)
+        return
+
+    queue = Queue()
+    listener = logging.handlers.QueueListener(queue, *handlers, respect_handler_level=True)
+    logger.addHandler(ThreadQueueHandler(queue))
+    listener.start()
+    reactor.addSystemEventTrigger('after', 'shutdown', listener.stop)
@@ -0,0 +1,188 @@
+from . import dedup, logsetup, metrics, recorder, servers, queues, routers, connections, build_router, changed_keys
+from .outbound import OutboundQueue
+from importlib import import_module
+from twisted.internet.task import LoopingCall
+from time import time
+import logging
+
+logger = logging.getLogger('chatrelay')
+
+def protocol_object(conf, server):
+    modname, objname = conf['protocols'][server['protocol']]
+    return getattr(import_module(modname), objname)
+
+def start(conf, worker=None):
+    """Set up logging and metrics and start every configured connection
+
+    With a chatrelay.shard.Worker, only connections owned by that worker are
+    started and messages for the rest are passed to their owners
+    """
+    logsetup.configure(conf)
+    if worker is None:
+        metrics.start(conf)
+        recorder.start(conf)
+    else:
+        metrics.start(conf, worker.metrics_port)
+        recorder.start(conf, worker.record_file)
+    dedup.cache.configure(conf)
+
+    for server in conf['servers']:
+        name = server['name']
+        if name in queues:
+            raise RuntimeError('Duplicate server name: {0}'.format(name))
+        if worker is None or worker.owns(name):
+            queues[name] = OutboundQueue(server)
+        else:
+            queues[name] = worker.remote_queue(server)
+
+    # queues for every server must exist before any channel_map is compiled.
+    # Protocol modules are only imported here, and init_connection() must not
+    # block, so connections are all established together once the reactor runs
+    report = StartupReport()
+    for server in conf['servers']:
+        name = server['name']
+        if worker is None or worker.owns(name):
+            imported = time()
+            obj = protocol_object(conf, server)
+            initialized = time()
+            connections[name] = obj.init_connection(server)
+            report.add(name, initialized - imported, time() - initialized)
+    report.start()
+
+class StartupReport(object):
+    """Logs how long each connection took to import, initialize and register
+
+    Connections that have not registered within `timeout` seconds are reported
+    as such
+    """
+
+    def __init__(self, timeout=60):
+        self.started = time()
+        self.timeout = timeout
+        self.timings = {}
+        self._watch = None
+
+    def add(self, name, import_time, init_time):
+        self.timings[name] = [import_time, init_time, None]
+
+    def start(self):
+        self._watch = LoopingCall(self._check)
+        self._watch.start(0.05, now=False)
+
+    def _check(self):
+        now = time()
+        up = 0
+        for name, timing in self.timings.items():
+            if timing[2] is None and name in servers:
+                timing[2] = now - self.started
+            if timing[2] is not None:
+                up += 1
+        if up == len(self.timings) or now - self.started >= self.timeout:
+            self._watch.stop()
+            self.log(up, now)
+
+    def log(self, up, now):
+        for name, (import_time, init_time, connected) in sorted(self.timings.items()):
+            if connected is None:
+                status = 'not connected after {0}s'.format(self.timeout)
+            else:
+                status = 'connected after {0:.2f}s'.format(connected)
+            logger.info('Startup :: {0}: import {1:.1f}ms, init {2:.1f}ms, {3}'.format(
+                name, import_time * 1000, init_time * 1000, status))
+        logger.info('Startup :: {0} of {1} connections up after {2:.2f}s'.format(
+            up, len(self.timings), now - self.started))
+
+
+def reload(conf, new, worker=None):
+    """Bring the running relay from config `conf` to `new`, updating `conf` in place
+
+    Settings a protocol can change live, like channel_map, are applied to the
+    running connection by its reconfigure(). Connections with other changes are
+    restarted, keeping their outbound queue. Removed servers are stopped and
+    added ones started. Top level settings other than dedup_* need a restart.
+    """
+    names = set()
+    for server in new['servers']:
+        if server['name'] in names:
+            raise RuntimeError('Duplicate server name: {0}'.format(server['name']))
+        names.add(server['name'])
+    for key in sorted(changed_keys(conf, new) - set(['servers', 'protocols', 'dedup_window', 'dedup_size'])):
+        logger.warn('Reload :: Ignoring change to {0}, restart to apply'.format(key))
+
+    def owned(name):
+        return worker is None or worker.owns(name)
+
+    running = dict((s['name'], s) for s in conf['servers'] if owned(s['name']))
+    if worker is not None:
+        worker.reassign(new)
+
+    kept = []
+    starting = []
+    for server in new['servers']:
+        name = server['name']
+        old = running.pop(name, None)
+        if not owned(name):
+            if old is not None:
+                stop(name)
+            queue = queues.get(name)
+            if queue is None or not queue.remote or worker.owners[name] != queue.peer.index:
+                queues[name] = worker.remote_queue(server)
+            kept.append(server)
+            continue
+
+        if old is None:
+            logger.info('Reload :: Starting {0}'.format(name))
+            queue = queues.get(name)
+            if queue is None or queue.remote:
+                queues[name] = OutboundQueue(server)
+            starting.append(server)
+            kept.append(server)
+        elif old['protocol'] == server['protocol'] and live_update(protocol_object(new, server), old, server):
+            # the running conf dict is updated in place and stays in use
+            kept.append(old)
+        elif stop(name):
+            logger.info('Reload :: Restarting {0}'.format(name))
+            if [key for key in changed_keys(old, server) if key.startswith(('queue_', 'replay_'))]:
+                logger.warn('Reload :: Queue settings for {0} apply after a restart'.format(name))
+            starting.append(server)
+            kept.append(server)
+        else:
+            kept.append(old)
+
+    for name, old in running.items():
+        logger.info('Reload :: Stopping {0}'.format(name))
+        if stop(name):
+            routers.pop(name, None)
+        else:
+            kept.append(old)
+            names.add(name)
+    for name in set(queues) - names:
+        del queues[name]
+
+    new = dict(new)
+    new['servers'] = kept
+    conf.clear()
+    conf.update(new)
+    dedup.cache.configure(conf)
+
+    # routers hold queue objects, so every one is rebuilt
+    starting_names = set(server['name'] for server in starting)
+    for server in conf['servers']:
+        if owned(server['name']) and server['name'] not in starting_names:
+            build_router(server)
+    for server in starting:
+        connections[server['name']] = protocol_object(conf, server).init_connection(server)
+
+def live_update(obj, old, server):
+    reconfigure = getattr(obj, 'reconfigure', None)
+    return reconfigure is not None and reconfigure(old, server)
+
+def stop(name):
+    """Stop a connection for good, returns False if its protocol does not support that"""
+    connection = connections.get(name)
+    if connection is None or not hasattr(connection, 'stop'):
+        logger.warn('Reload :: {0} cannot be stopped, restart to apply changes'.format(name))
+        return False
+    del connections[name]
+    connection.stop()
+    return True
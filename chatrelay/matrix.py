@@ -1,34 +1,46 @@
+import json
 import logging
+import os
 
-from . import servers
+from . import register, trace
+from .appservice import puppet_localpart
 from copy import deepcopy
 from os import fdopen
 from tempfile import mkstemp
-from twisted.internet import reactor
-
-import synapse.config.homeserver
-import synapse.app.homeserver
-import synapse.storage.engines
-import synapse.crypto
-import synapse.storage.prepare_database
-import synapse.util.stringutils
-
-# configure synapse base logging
-logger = logging.getLogger('synapse')
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter('%(name)s - %(message)s'))
-handler.setLevel(logging.INFO)
-logger.addHandler(handler)
-
-# make noisy synapse loggers quieter
-noisy_loggers = ('synapse.storage', 'synapse.handlers.typing', 'synapse.handlers.presence')
-for logger_name in noisy_loggers:
-    logging.getLogger(logger_name).setLevel(logging.ERROR)
-
-# Use the normal chatrelay logger for our own messages
+from twisted.internet import reactor, threads, defer
+from twisted.python.failure import Failure
+
 logger = logging.getLogger('chatrelay')
 
+# synapse is heavy to import, so it is only imported once a matrix server is
+# started, see _import_synapse()
+synapse = None
+
+def _import_synapse():
+    global synapse
+    if synapse is not None:
+        return
+    import synapse.config.homeserver
+    import synapse.app.homeserver
+    import synapse.storage.engines
+    import synapse.crypto
+    import synapse.storage.prepare_database
+    import synapse.util.stringutils
+    import synapse.types
+
+    # configure synapse base logging
+    synapse_logger = logging.getLogger('synapse')
+    synapse_logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(name)s - %(message)s'))
+    handler.setLevel(logging.INFO)
+    synapse_logger.addHandler(handler)
+
+    # make noisy synapse loggers quieter
+    noisy_loggers = ('synapse.storage', 'synapse.handlers.typing', 'synapse.handlers.presence')
+    for logger_name in noisy_loggers:
+        logging.getLogger(logger_name).setLevel(logging.ERROR)
+
 # The chatrelay matrix config is largely a subset of the actual synapse config.
 # We build up the actual synapse config into this dictionary, as it would have been
 # parsed from yaml
@@ -108,12 +120,42 @@ _base_listener = {
 class SynapseRelay(object):
     @classmethod
     def init_connection(cls, conf):
+        k = 'macaroon_secret_key'
+        minlen = 50
+        if len(conf.get(k) or '') < minlen:
+            # generate a new key if missing
+            _import_synapse()
+            fd, fn = mkstemp()
+            with fdopen(fd, 'w') as f:
+                new_key = synapse.util.stringutils.random_string_with_symbols(minlen)
+                f.write('{0}: "{1}"\n'.format(k, new_key))
+            raise RuntimeError('Missing {0} from matrix server config, a new key has been '
+                'generated in {1}, please copy this into the config and then delete the '
+                'file'.format(k, fn))
+
+        # importing synapse and reading its config take seconds, so they run
+        # in a thread once the reactor is running and the other connections
+        # have started
+        reactor.callWhenRunning(cls._setup, conf)
+
+    @classmethod
+    def _setup(cls, conf):
+        d = threads.deferToThread(cls._read_config, conf)
+        d.addCallback(cls._create_homeserver)
+        d.addCallback(cls._start_homeserver, conf)
+        d.addErrback(cls._start_failed, conf)
+
+    @staticmethod
+    def _read_config(conf):
+        _import_synapse()
+
         ## prepare config
 
         # required_keys get copied into the synapse config directly
         required_keys = (
             'server_name',
             'signing_key_path',
+            'macaroon_secret_key',
         )
         for k in required_keys:
             _synapse_config[k] = conf[k]
@@ -121,22 +163,6 @@ class SynapseRelay(object):
         # special cases
         _synapse_config['database']['args']['database'] = conf['db_file']
 
-        k = 'macaroon_secret_key'
-        minlen = 50
-        try:
-            if len(conf[k]) < minlen:
-                raise Exception()
-            _synapse_config[k] = conf[k]
-        except Exception:
-            # generate a new key if missing
-            fd, fn = mkstemp()
-            with fdopen(fd, 'w') as f:
-                new_key = synapse.util.stringutils.random_string_with_symbols(minlen)
-                f.write('{0}: "{1}"\n'.format(k, new_key))
-            raise RuntimeError('Missing {0} from matrix server config, a new key has been '
-                'generated in {1}, please copy this into the config and then delete the '
-                'file'.format(k, fn))
-
         # opt_keys are copied directly if set
         opt_keys = ('media_store_path', 'uploads_path')
         for k in opt_keys:
@@ -155,7 +181,10 @@ class SynapseRelay(object):
         # process dict into synapse's expected object
         synapse_config = synapse.config.homeserver.HomeServerConfig()
         synapse_config.invoke_all('read_config', _synapse_config)
+        return synapse_config
 
+    @classmethod
+    def _create_homeserver(cls, synapse_config):
         ## This is mostly a copy/paste from synapse.app.homeserver.setup
 
         if synapse_config.no_tls:
@@ -174,6 +203,14 @@ class SynapseRelay(object):
             database_engine=db_engine,
         )
 
+        # preparing the database can take a long time, so it also runs in a
+        # thread
+        d = threads.deferToThread(cls._prepare_database, hs, db_engine, synapse_config)
+        d.addCallback(lambda _: hs)
+        return d
+
+    @staticmethod
+    def _prepare_database(hs, db_engine, synapse_config):
         db_conn = hs.get_db_conn(run_new_connection=False)
         synapse.storage.prepare_database.prepare_database(db_conn, db_engine, config=synapse_config)
         db_engine.on_new_connection(db_conn)
@@ -182,6 +219,8 @@ class SynapseRelay(object):
 
         db_conn.commit()
 
+    @classmethod
+    def _start_homeserver(cls, hs, conf):
         hs.setup()
         hs.start_listening()
 
@@ -197,18 +236,176 @@ class SynapseRelay(object):
         ## END copy/paste
 
         # instantiate and register the object globally
-        servers[conf['name']] = cls(conf, hs)
+        register(conf['name'], cls(conf, hs))
+
+    @staticmethod
+    def _start_failed(failure, conf):
+        logger.error('{0} :: Failed to start homeserver: {1}'.format(conf['name'], failure.getErrorMessage()))
 
 
     def __init__(self, conf, homeserver):
         self.conf = conf
         self.homeserver = homeserver
+        self.puppets = PuppetCache(conf.get('puppet_cache_file', conf['db_file'] + '.puppets'))
+        self.batch_window = conf.get('batch_window', 0.1)
+        self.batch_max = conf.get('batch_max', 20)
+        # room -> [(fromnick, fromserver, message, Deferred)] waiting to be sent
+        self._batches = {}
+        self._flushes = {}
+        # room -> Deferred of the last send, so sends to a room stay in order
+        self._sending = {}
+        self._room_ids = {}
 
     def relay_message(self, destchan, message, fromnick=None, fromserver=None):
+        """Messages to a room are collected for `batch_window` seconds, and each
+        run of consecutive lines from one sender is sent as a single event
+        """
+        trace.debug(u'%s => %s from %s :%s', self.conf['name'], destchan, fromnick, message)
+        d = defer.Deferred()
+        batch = self._batches.setdefault(destchan, [])
+        batch.append((fromnick, fromserver, message, d))
+        if len(batch) >= self.batch_max:
+            self._flush(destchan)
+        elif destchan not in self._flushes:
+            self._flushes[destchan] = reactor.callLater(self.batch_window, self._flush, destchan)
+        return d
+
+    def _flush(self, room):
+        call = self._flushes.pop(room, None)
+        if call is not None and call.active():
+            call.cancel()
+        batch = self._batches.pop(room, [])
+        runs = []
+        for fromnick, fromserver, message, d in batch:
+            if runs and runs[-1][0] == (fromnick, fromserver):
+                runs[-1][1].append(message)
+                runs[-1][2].append(d)
+            else:
+                runs.append(((fromnick, fromserver), [message], [d]))
+
+        last = self._sending.get(room, defer.succeed(None))
+        for (fromnick, fromserver), messages, waiters in runs:
+            last.addBoth(lambda _, f=fromnick, s=fromserver, m=messages: self._send(room, f, s, u'\n'.join(m)))
+            last.addBoth(self._notify, waiters)
+        self._sending[room] = last
+
+    def _notify(self, result, waiters):
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        # failures are reported through the waiters, keep the room's chain going
+        return None
+
+    @defer.inlineCallbacks
+    def _send(self, room, fromnick, fromserver, text):
+        room_id = yield self._room_id(room)
         if fromnick:
+            user_id = yield self._puppet(fromnick, fromserver)
+            msgtype = 'm.text'
+        else:
+            user_id = yield self._puppet(self.conf.get('service_nick', 'relay'), None)
+            msgtype = 'm.notice'
+        requester = synapse.types.create_requester(user_id)
+        handlers = self.homeserver.get_handlers()
+        if not self.puppets.joined(user_id, room_id):
+            yield handlers.room_member_handler.update_membership(
+                requester, requester.user, room_id, 'join', ratelimit=False)
+            self.puppets.set_joined(user_id, room_id)
+        yield handlers.message_handler.create_and_send_nonmember_event(requester, {
+            'type': 'm.room.message',
+            'room_id': room_id,
+            'sender': user_id,
+            'content': {'msgtype': msgtype, 'body': text},
+        }, ratelimit=False)
+
+    @defer.inlineCallbacks
+    def _puppet(self, fromnick, fromserver):
+        """Returns a Deferred firing with the user ID of a sender's puppet, created on first use"""
+        user_id = self.puppets.get(fromnick, fromserver)
+        if user_id is None:
             reg_handler = self.homeserver.get_handlers().registration_handler
-            user_id, token = reg_handler.get_or_create_user(
-                localpart=fromnick,
+            user_id, token = yield reg_handler.get_or_create_user(
+                localpart=puppet_localpart(self.conf.get('puppet_prefix', ''), fromnick, fromserver),
                 requester=None,
             )
-        # TODO
+            self.puppets.set(fromnick, fromserver, user_id, token)
+        defer.returnValue(user_id)
+
+    @defer.inlineCallbacks
+    def _room_id(self, room):
+        if room.startswith('!'):
+            defer.returnValue(room)
+        room_id = self._room_ids.get(room)
+        if room_id is None:
+            alias = synapse.types.RoomAlias.from_string(room)
+            res = yield self.homeserver.get_handlers().directory_handler.get_association(alias)
+            room_id = self._room_ids[room] = res['room_id']
+        defer.returnValue(room_id)
+
+    def sizes(self):
+        return {'puppets': len(self.puppets), 'room_ids': len(self._room_ids)}
+
+
+class PuppetCache(object):
+    """Persistent (fromserver, fromnick) -> puppet user ID, access token and joined rooms
+
+    Saves the registration handler and database lookups on every message. The
+    file is rewritten at most once a second after a change, and at shutdown.
+    It holds access tokens, so only the owner can read it.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self._rooms = {}
+        self._save = None
+        try:
+            with open(filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            pass
+        for user_id, token, rooms in self.entries.values():
+            self._rooms[user_id] = set(rooms)
+        reactor.addSystemEventTrigger('after', 'shutdown', self.save)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _key(self, fromnick, fromserver):
+        return u'{0}\t{1}'.format(fromserver or u'', fromnick)
+
+    def get(self, fromnick, fromserver):
+        entry = self.entries.get(self._key(fromnick, fromserver))
+        return entry[0] if entry is not None else None
+
+    def set(self, fromnick, fromserver, user_id, token):
+        self.entries[self._key(fromnick, fromserver)] = [user_id, token, []]
+        self._rooms[user_id] = set()
+        self._changed()
+
+    def joined(self, user_id, room_id):
+        return room_id in self._rooms.get(user_id, ())
+
+    def set_joined(self, user_id, room_id):
+        self._rooms.setdefault(user_id, set()).add(room_id)
+        self._changed()
+
+    def _changed(self):
+        if self._save is None:
+            self._save = reactor.callLater(1, self.save)
+
+    def save(self):
+        if self._save is not None and self._save.active():
+            self._save.cancel()
+        self._save = None
+        for entry in self.entries.values():
+            entry[2] = sorted(self._rooms.get(entry[0], ()))
+        tmpname = self.filename + '.tmp'
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # in case a leftover temp file was created with other permissions
+        os.fchmod(fd, 0o600)
+        with fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmpname, self.filename)
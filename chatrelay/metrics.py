@@ -0,0 +1,153 @@
+from bisect import bisect_left
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+import logging
+
+logger = logging.getLogger('chatrelay')
+
+# Call sites check this before doing any work, so collection costs a single
+# attribute lookup unless the metrics endpoint has been started
+enabled = False
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTERS = {
+    'inbound_messages': 'Lines or events received',
+    'inbound_bytes': 'Bytes of lines or events received',
+    'inbound_skipped': 'Events dropped by type before being decoded',
+    'outbound_messages': 'Messages delivered with relay_message()',
+    'outbound_bytes': 'Bytes of message text delivered',
+    'delivery_failures': 'Failed relay_message() calls',
+}
+
+_counters = {}
+_stages = {}
+_relay = {}
+
+class Histogram(object):
+    """Cumulative latency histogram in the Prometheus sense"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def render(self, name, labels, out):
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            out.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(name, labels, bound, total))
+        out.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labels, self.count))
+        out.append('{0}_sum{{{1}}} {2}'.format(name, labels, self.sum))
+        out.append('{0}_count{{{1}}} {2}'.format(name, labels, self.count))
+
+
+def inc(counter, server, value=1):
+    key = (counter, server)
+    _counters[key] = _counters.get(key, 0) + value
+
+def observe(stage, server, seconds):
+    """Record the time spent in one processing stage for a server"""
+    key = (stage, server)
+    hist = _stages.get(key)
+    if hist is None:
+        hist = _stages[key] = Histogram()
+    hist.observe(seconds)
+
+def observe_relay(server, seconds):
+    """Record end-to-end latency from receipt of a message to delivery by `server`"""
+    hist = _relay.get(server)
+    if hist is None:
+        hist = _relay[server] = Histogram()
+    hist.observe(seconds)
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format"""
+    from . import servers, queues, dedup
+    out = []
+    for counter, help in sorted(COUNTERS.items()):
+        name = 'chatrelay_{0}_total'.format(counter)
+        out.append('# HELP {0} {1}'.format(name, help))
+        out.append('# TYPE {0} counter'.format(name))
+        for (c, server), value in sorted(_counters.items()):
+            if c == counter:
+                out.append('{0}{{server="{1}"}} {2}'.format(name, server, value))
+
+    for name, help, value in (
+            ('dedup_suppressed', 'Inbound messages dropped as echoes or duplicates', dedup.cache.suppressed),
+            ('dedup_skipped', 'Deliveries skipped because the message was already seen there', dedup.cache.skipped)):
+        name = 'chatrelay_{0}_total'.format(name)
+        out.append('# HELP {0} {1}'.format(name, help))
+        out.append('# TYPE {0} counter'.format(name))
+        out.append('{0} {1}'.format(name, value))
+
+    out.append('# HELP chatrelay_stage_seconds Time spent in each processing stage')
+    out.append('# TYPE chatrelay_stage_seconds histogram')
+    for (stage, server), hist in sorted(_stages.items()):
+        hist.render('chatrelay_stage_seconds', 'stage="{0}",server="{1}"'.format(stage, server), out)
+
+    out.append('# HELP chatrelay_relay_seconds Time from receipt of a message until delivered, by destination')
+    out.append('# TYPE chatrelay_relay_seconds histogram')
+    for server, hist in sorted(_relay.items()):
+        hist.render('chatrelay_relay_seconds', 'server="{0}"'.format(server), out)
+
+    # queue and state metrics are read at scrape time only, for servers owned
+    # by this process
+    local = [(server, queue) for server, queue in sorted(queues.items()) if not queue.remote]
+    queue_metrics = [
+        ('queue_depth', 'gauge', 'Messages waiting in the outbound queue', lambda q: q.depth),
+        ('replay_depth', 'gauge', 'Messages held for replay while disconnected', lambda q: len(q.replay)),
+        ('spool_depth', 'gauge', 'Undelivered messages in the durable spool', lambda q: len(q.spool) if q.spool is not None else 0),
+        ('queue_dropped_total', 'counter', 'Messages dropped from a full outbound queue', lambda q: q.dropped),
+        ('queue_merged_total', 'counter', 'Messages merged into another queued message', lambda q: q.merged),
+    ]
+    for metric, type, help, get in queue_metrics:
+        name = 'chatrelay_{0}'.format(metric)
+        out.append('# HELP {0} {1}'.format(name, help))
+        out.append('# TYPE {0} {1}'.format(name, type))
+        for server, queue in local:
+            out.append('{0}{{server="{1}"}} {2}'.format(name, server, get(queue)))
+
+    out.append('# HELP chatrelay_connected Whether the connection is currently registered')
+    out.append('# TYPE chatrelay_connected gauge')
+    for server, queue in local:
+        out.append('chatrelay_connected{{server="{0}"}} {1}'.format(server, int(server in servers)))
+
+    out.append('# HELP chatrelay_state_size Entries in per-connection state tables')
+    out.append('# TYPE chatrelay_state_size gauge')
+    for server, proto in sorted(servers.items()):
+        sizes = getattr(proto, 'sizes', None)
+        if sizes is not None:
+            for table, size in sorted(sizes().items()):
+                out.append('chatrelay_state_size{{server="{0}",table="{1}"}} {2}'.format(server, table, size))
+    out.append('')
+    return '\n'.join(out)
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return render().encode('utf-8')
+
+
+def start(conf, port=None):
+    """Start collecting and serve metrics over HTTP if `metrics_port` is configured,
+    or on `port` if given
+    """
+    global enabled
+    port = port or conf.get('metrics_port')
+    if not port:
+        return
+    interface = conf.get('metrics_bind', '127.0.0.1')
+    reactor.listenTCP(port, Site(MetricsResource()), interface=interface)
+    enabled = True
+    logger.info('Serving metrics on http://{0}:{1}/metrics'.format(interface, port))
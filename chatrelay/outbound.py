@@ -0,0 +1,460 @@
+from . import servers, metrics
+from collections import deque, OrderedDict
+from time import time
+from twisted.internet import reactor, defer
+import json
+import logging
+import os
+
+logger = logging.getLogger('chatrelay')
+
+class TokenBucket(object):
+    """Classic token bucket, `rate` tokens per second up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time()
+
+    def take(self):
+        """Consume a token, returning 0, or return seconds until one is available"""
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Latency(object):
+    """Running count/total/max of observed latencies in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class ReplayBuffer(object):
+    """Ring buffer of messages for a connection that is down, replayed in order on reconnect
+
+    Bounded by `replay_max_count` messages and `replay_max_age` seconds. If
+    `replay_file` is set the buffer is also appended to that file so it survives
+    a restart.
+    """
+
+    def __init__(self, conf):
+        self.name = conf['name']
+        self.max_count = conf.get('replay_max_count', 500)
+        self.max_age = conf.get('replay_max_age', 900)
+        self.filename = conf.get('replay_file')
+        self.buffer = deque(maxlen=self.max_count or None)
+        self.lost = 0
+        self._file = None
+        self._file_lines = 0
+        if self.filename:
+            self._load()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def add(self, destchan, message, fromnick=None, fromserver=None):
+        if not self.max_count:
+            self.lost += 1
+            return
+        if len(self.buffer) == self.max_count:
+            self.lost += 1
+        entry = [time(), destchan, message, fromnick, fromserver]
+        self.buffer.append(entry)
+        if self.filename:
+            self._spill(entry)
+
+    def drain(self):
+        """Yield buffered items that have not expired, oldest first, and empty the buffer"""
+        cutoff = time() - self.max_age
+        while self.buffer:
+            entry = self.buffer.popleft()
+            if entry[0] < cutoff:
+                self.lost += 1
+                continue
+            yield entry[1:]
+        if self.filename:
+            self._truncate()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partial last line from a crash
+                        continue
+                    self.buffer.append(entry)
+        except IOError:
+            return
+        logger.info('{0} :: Loaded {1} messages to replay from {2}'.format(self.name, len(self.buffer), self.filename))
+        self._rewrite()
+
+    def _spill(self, entry):
+        if self._file is None:
+            self._file = open(self.filename, 'a')
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        self._file_lines += 1
+        if self._file_lines > 2 * self.max_count:
+            self._rewrite()
+
+    def _rewrite(self):
+        """Compact the spill file down to the current buffer contents"""
+        if self._file is not None:
+            self._file.close()
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            for entry in self.buffer:
+                f.write(json.dumps(entry) + '\n')
+        os.rename(tmpname, self.filename)
+        self._file = open(self.filename, 'a')
+        self._file_lines = len(self.buffer)
+
+    def _truncate(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        self._file_lines = 0
+
+
+class Spool(object):
+    """Append-only log of the messages queued for a connection until they are delivered
+
+    Each message gets an `a` record when queued and a `d` record once it has
+    been delivered or discarded. Writes are fsynced together at most every
+    `spool_sync` seconds, so a crash loses at most that much. Messages without
+    a `d` record are queued again on startup. The log is rewritten to just the
+    pending messages when finished ones outnumber them.
+    """
+
+    COMPACT_MIN = 1000
+
+    def __init__(self, conf):
+        self.name = conf['name']
+        self.filename = conf['spool_file']
+        self.sync_interval = conf.get('spool_sync', 0.1)
+        self.pending = OrderedDict()
+        self.next_id = 1
+        self.records = 0
+        self._sync = None
+        self._file = None
+        self._load()
+        self._compact()
+        reactor.addSystemEventTrigger('after', 'shutdown', self.sync)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, destchan, message, fromnick=None, fromserver=None):
+        """Record a queued message, returns its ID"""
+        id = self.next_id
+        self.next_id += 1
+        self.pending[id] = [destchan, message, fromnick, fromserver]
+        self._write(['a', id, destchan, message, fromnick, fromserver])
+        return id
+
+    def ack(self, ids):
+        """Record that the messages with these IDs are finished with"""
+        for id in ids:
+            if self.pending.pop(id, None) is not None:
+                self._write(['d', id])
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self.records += 1
+        if self._sync is None:
+            self._sync = reactor.callLater(self.sync_interval, self.sync)
+
+    def sync(self):
+        if self._sync is not None and self._sync.active():
+            self._sync.cancel()
+        self._sync = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self.records > max(Spool.COMPACT_MIN, 2 * len(self.pending)):
+            self._compact()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partial last line from a crash
+                        continue
+                    if record[0] == 'a':
+                        self.pending[record[1]] = record[2:]
+                        self.next_id = max(self.next_id, record[1] + 1)
+                    else:
+                        self.pending.pop(record[1], None)
+        except IOError:
+            return
+        logger.info('{0} :: Loaded {1} undelivered messages from {2}'.format(self.name, len(self.pending), self.filename))
+
+    def _compact(self):
+        if self._file is not None:
+            self._file.close()
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            for id, entry in self.pending.items():
+                f.write(json.dumps(['a', id] + entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpname, self.filename)
+        self._file = open(self.filename, 'a')
+        self.records = len(self.pending)
+
+
+class OutboundQueue(object):
+    """Bounded, rate limited queue of messages waiting to be relayed to one connection
+
+    Channels are served round-robin so a flood in one channel does not starve the
+    others. When full, `queue_policy` decides what happens to a new message:
+      drop_oldest - discard the oldest message from the busiest channel
+      drop_newest - discard the new message
+      merge       - append to the last queued message if it is from the same
+                    sender to the same channel, otherwise drop_oldest
+
+    With `queue_coalesce_max` set, consecutive queued messages from the same
+    sender to the same channel are joined with newlines, up to that many
+    characters, when taken off the queue, so the rate limit counts posts
+    rather than lines.
+
+    With a `spool_file`, queued messages are also kept in a Spool until
+    delivered so they survive a restart, and held in the queue rather than the
+    ReplayBuffer while the connection is down. Failed deliveries are retried up
+    to `spool_retries` times.
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'merge')
+
+    # see chatrelay.shard.RemoteQueue
+    remote = False
+
+    def __init__(self, conf):
+        self.name = conf['name']
+        rate = conf.get('queue_rate')
+        if rate:
+            self.bucket = TokenBucket(rate, conf.get('queue_burst', 1))
+        else:
+            self.bucket = None
+        self.maxsize = conf.get('queue_size', 1000)
+        self.policy = conf.get('queue_policy', 'drop_oldest')
+        if self.policy not in OutboundQueue.POLICIES:
+            raise RuntimeError('{0} :: Invalid queue_policy {1}'.format(self.name, self.policy))
+        self.merge_max = conf.get('queue_merge_max', 400)
+        self.coalesce_max = conf.get('queue_coalesce_max')
+        self.replay = ReplayBuffer(conf)
+        self.retries = conf.get('spool_retries', 5)
+        self._attempts = {}
+
+        self.channels = {}
+        self.ready = deque()
+        self.depth = 0
+        self._call = None
+
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.merged = 0
+        self.delivered = Latency()
+        self.failed = Latency()
+
+        if conf.get('spool_file'):
+            self.spool = Spool(conf)
+            for id, entry in self.spool.pending.items():
+                self._append(*entry, ids=[id])
+        else:
+            self.spool = None
+
+    def put(self, destchan, message, fromnick=None, fromserver=None, received=None):
+        if self.name not in servers and self.spool is None:
+            # connection is down, hold it for replay
+            self.replay.add(destchan, message, fromnick, fromserver)
+            return
+        self._append(destchan, message, fromnick, fromserver, received)
+
+    def _append(self, destchan, message, fromnick, fromserver, received=None, ids=None):
+        if self.depth >= self.maxsize:
+            if self.policy == 'drop_newest':
+                self._count_drop()
+                self._ack(ids)
+                return
+            if self.policy == 'merge' and self._merge(destchan, message, fromnick, fromserver, ids):
+                return
+            self._drop_oldest()
+        if ids is None and self.spool is not None:
+            ids = [self.spool.add(destchan, message, fromnick, fromserver)]
+        chanq = self.channels.get(destchan)
+        if chanq is None:
+            chanq = self.channels[destchan] = deque()
+            self.ready.append(destchan)
+        chanq.append([destchan, message, fromnick, fromserver, received, ids])
+        self.depth += 1
+        self._schedule(0)
+
+    def _merge(self, destchan, message, fromnick, fromserver, ids=None):
+        chanq = self.channels.get(destchan)
+        if not chanq:
+            return False
+        item = chanq[-1]
+        if item[2] != fromnick or item[3] != fromserver:
+            return False
+        merged = u'{0} | {1}'.format(item[1], message)
+        if len(merged) > self.merge_max:
+            return False
+        item[1] = merged
+        self.merged += 1
+        if self.spool is not None:
+            # both parts stay in the spool until the merged message is delivered
+            if ids is None:
+                ids = [self.spool.add(destchan, message, fromnick, fromserver)]
+            item[5] = (item[5] or []) + ids
+        return True
+
+    def _drop_oldest(self):
+        destchan = max(self.channels, key=lambda c: len(self.channels[c]))
+        self._ack(self._pop(destchan)[5])
+        self._count_drop()
+
+    def _ack(self, ids):
+        if ids:
+            for id in ids:
+                self._attempts.pop(id, None)
+            self.spool.ack(ids)
+
+    def _count_drop(self):
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            logger.warn('{0} :: Outbound queue full, {1} messages dropped so far'.format(self.name, self.dropped))
+
+    def _pop(self, destchan):
+        chanq = self.channels[destchan]
+        item = chanq.popleft()
+        if not chanq:
+            del self.channels[destchan]
+            self.ready.remove(destchan)
+        self.depth -= 1
+        return item
+
+    def _next(self):
+        destchan = self.ready.popleft()
+        chanq = self.channels[destchan]
+        item = chanq.popleft()
+        if chanq:
+            self.ready.append(destchan)
+        else:
+            del self.channels[destchan]
+        self.depth -= 1
+        return item
+
+    def _coalesce(self, item):
+        """Joins the queued messages following item from the same sender onto it"""
+        destchan = item[0]
+        length = len(item[1])
+        lines = [item[1]]
+        ids = item[5]
+        while destchan in self.channels:
+            nextitem = self.channels[destchan][0]
+            if nextitem[2] != item[2] or nextitem[3] != item[3]:
+                break
+            if length + 1 + len(nextitem[1]) > self.coalesce_max:
+                break
+            self._pop(destchan)
+            lines.append(nextitem[1])
+            length += 1 + len(nextitem[1])
+            if nextitem[5]:
+                ids = (ids or []) + nextitem[5]
+        if len(lines) > 1:
+            self.merged += len(lines) - 1
+            item[1] = u'\n'.join(lines)
+            item[5] = ids
+        return item
+
+    def _schedule(self, delay):
+        if self._call is None:
+            self._call = reactor.callLater(delay, self._drain)
+
+    def resume(self):
+        """Called when the connection is (re)registered to flush held messages"""
+        if len(self.replay):
+            count = 0
+            for item in self.replay.drain():
+                self._append(*item)
+                count += 1
+            logger.info('{0} :: Replaying {1} messages'.format(self.name, count))
+        if self.depth:
+            self._schedule(0)
+
+    def _drain(self):
+        self._call = None
+        while self.depth:
+            if self.name not in servers:
+                # connection went down, hold messages until resume()
+                return
+            if self.bucket is not None:
+                delay = self.bucket.take()
+                if delay:
+                    self._schedule(delay)
+                    return
+            item = self._next()
+            if self.coalesce_max:
+                item = self._coalesce(item)
+            self._deliver(item)
+
+    def _deliver(self, item):
+        start = time()
+        d = defer.maybeDeferred(servers[self.name].relay_message, *item[:4])
+        d.addCallbacks(self._delivered, self._failed, callbackArgs=(start, item), errbackArgs=(start, item))
+
+    def _delivered(self, res, start, item):
+        now = time()
+        self.sent += 1
+        self.delivered.record(now - start)
+        if metrics.enabled:
+            metrics.observe('deliver', self.name, now - start)
+            metrics.inc('outbound_messages', self.name)
+            metrics.inc('outbound_bytes', self.name, len(item[1]))
+            if item[4] is not None:
+                metrics.observe_relay(self.name, now - item[4])
+        self._ack(item[5])
+
+    def _failed(self, failure, start, item):
+        self.failed.record(time() - start)
+        if metrics.enabled:
+            metrics.inc('delivery_failures', self.name)
+        logger.error('{0} :: Failed to relay message to {1}: {2}'.format(self.name, item[0], failure.getErrorMessage()))
+        ids = item[5]
+        if not ids:
+            return
+        attempts = self._attempts.get(ids[0], 0) + 1
+        if attempts > self.retries:
+            logger.error('{0} :: Giving up on message to {1} after {2} attempts'.format(self.name, item[0], attempts))
+            self._ack(ids)
+            return
+        self._attempts[ids[0]] = attempts
+        reactor.callLater(min(60, 2 ** attempts), self._append, *item)
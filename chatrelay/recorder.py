@@ -0,0 +1,50 @@
+from twisted.internet import reactor
+from time import time
+import json
+import logging
+
+logger = logging.getLogger('chatrelay')
+
+# Call sites check this before doing any work, like metrics.enabled
+enabled = False
+
+_file = None
+_names = set()
+
+def start(conf, filename=None):
+    """Append inbound traffic to `record_file` if configured, or to `filename`
+    if given, see bench/loadtest.py
+    """
+    global enabled, _file
+    filename = filename or conf.get('record_file')
+    if not filename:
+        return
+    _file = open(filename, 'a')
+    enabled = True
+    reactor.addSystemEventTrigger('after', 'shutdown', stop)
+    logger.info('Recording inbound traffic to {0}'.format(filename))
+
+def stop():
+    global enabled
+    enabled = False
+    if _file is not None:
+        _file.close()
+
+def record(server, kind, data):
+    """Write one trace entry
+
+    `kind` is `line` for a raw IRC line, `frame` for a Slack RTM event
+    payload or `event` for a Matrix event pushed to an application service, as
+    received by the `server` connection
+    """
+    _file.write(json.dumps([time(), server, kind, data]) + '\n')
+
+def record_name(server, kind, id, name):
+    """Write an ID -> name resolution once, so replays can answer lookups
+
+    `kind` is `channel` or `user`
+    """
+    key = (server, kind, id)
+    if key not in _names:
+        _names.add(key)
+        record(server, kind, [id, name])
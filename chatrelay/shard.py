@@ -0,0 +1,302 @@
+from . import dedup, logsetup, queues, tobytes, Backoff
+from collections import deque
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('chatrelay')
+
+def assign(conf, workers, previous=None):
+    """Map each server name to the index of the worker process that owns it
+
+    Servers can be pinned to a worker with `worker`. Servers in `previous`, the
+    assignment before a reload, stay where they are, and the rest go to the
+    worker with the fewest servers in config order. The result depends only on
+    the arguments, so every process computes the same one.
+    """
+    previous = previous or {}
+    owners = {}
+    counts = [0] * workers
+    for server in conf['servers']:
+        name = server['name']
+        index = server.get('worker')
+        if index is None:
+            index = previous.get(name)
+            if index is None or index >= workers:
+                continue
+        elif not 0 <= index < workers:
+            raise RuntimeError('{0} :: worker must be between 0 and {1}'.format(name, workers - 1))
+        owners[name] = index
+        counts[index] += 1
+    for server in conf['servers']:
+        name = server['name']
+        if name not in owners:
+            index = counts.index(min(counts))
+            owners[name] = index
+            counts[index] += 1
+    return owners
+
+def socket_path(ipc_dir, index):
+    return os.path.join(ipc_dir, 'worker-{0}.sock'.format(index))
+
+def owners_path(ipc_dir):
+    return os.path.join(ipc_dir, 'owners.json')
+
+def read_owners(ipc_dir):
+    """Returns the number of workers and the assignment written by the supervisor"""
+    with open(owners_path(ipc_dir)) as f:
+        data = json.load(f)
+    return data['workers'], data['owners']
+
+
+class BusProtocol(Int32StringReceiver):
+    """One message per length-prefixed frame, a compact JSON array of
+    [dest, destchan, message, fromnick, fromserver, received]
+    """
+
+    def stringReceived(self, frame):
+        self.factory.worker.deliver(*json.loads(frame.decode('utf-8')))
+
+
+class BusFactory(protocol.ServerFactory):
+    protocol = BusProtocol
+
+    def __init__(self, worker):
+        self.worker = worker
+
+
+class PeerProtocol(Int32StringReceiver):
+    def connectionMade(self):
+        self.factory.connected(self)
+
+    def connectionLost(self, reason):
+        self.factory.proto = None
+
+
+class Peer(protocol.ClientFactory):
+    """Connection to the bus socket of another worker
+
+    Frames are held while it is down, e.g. being restarted, up to `ipc_buffer`
+    (default 1000) after which the oldest are dropped
+    """
+
+    protocol = PeerProtocol
+
+    def __init__(self, conf, index, path):
+        self.index = index
+        self.proto = None
+        self.pending = deque()
+        self.maxsize = conf.get('ipc_buffer', 1000)
+        self.dropped = 0
+        self.backoff = Backoff({'reconnect_initial': 0.5, 'reconnect_max': 5, 'reconnect_stable': 10})
+        reactor.connectUNIX(path, self)
+
+    def send(self, frame):
+        if self.proto is not None:
+            self.proto.sendString(frame)
+            return
+        if len(self.pending) >= self.maxsize:
+            self.pending.popleft()
+            self.dropped += 1
+        self.pending.append(frame)
+
+    def connected(self, proto):
+        logger.debug('Connected to worker {0}, sending {1} held messages'.format(self.index, len(self.pending)))
+        self.backoff.connected()
+        self.proto = proto
+        while self.pending:
+            proto.sendString(self.pending.popleft())
+
+    def clientConnectionLost(self, connector, reason):
+        self._retry(connector)
+
+    def clientConnectionFailed(self, connector, reason):
+        self._retry(connector)
+
+    def _retry(self, connector):
+        self.proto = None
+        reactor.callLater(self.backoff.next_delay(), connector.connect)
+
+
+class RemoteQueue(object):
+    """Stands in for the OutboundQueue of a server owned by another worker"""
+
+    remote = True
+
+    def __init__(self, name, peer):
+        self.name = name
+        self.peer = peer
+
+    def put(self, destchan, message, fromnick=None, fromserver=None, received=None):
+        frame = json.dumps([self.name, destchan, message, fromnick, fromserver, received], separators=(',', ':'))
+        self.peer.send(tobytes(frame))
+
+    def resume(self):
+        pass
+
+
+class Worker(object):
+    """Runs the connections assigned to one worker process"""
+
+    def __init__(self, conf, index, ipc_dir):
+        self.conf = conf
+        self.index = index
+        self.ipc_dir = ipc_dir
+        self.peers = {}
+        self.reassign(conf)
+
+        # per-process resources get one each, kept out of conf so reloads
+        # don't see them as changed
+        self.metrics_port = conf['metrics_port'] + index if conf.get('metrics_port') else None
+        self.record_file = '{0}.{1}'.format(conf['record_file'], index) if conf.get('record_file') else None
+
+    def reassign(self, conf):
+        # the supervisor's assignment keeps servers where they are across
+        # reloads and worker restarts, only servers it hasn't seen yet are
+        # placed here, the same way the supervisor will
+        workers, owners = read_owners(self.ipc_dir)
+        self.owners = assign(conf, workers, owners)
+
+    def owns(self, name):
+        return self.owners[name] == self.index
+
+    def remote_queue(self, server):
+        index = self.owners[server['name']]
+        peer = self.peers.get(index)
+        if peer is None:
+            peer = self.peers[index] = Peer(self.conf, index, socket_path(self.ipc_dir, index))
+        return RemoteQueue(server['name'], peer)
+
+    def listen(self):
+        path = socket_path(self.ipc_dir, self.index)
+        if os.path.exists(path):
+            # left over from a crashed run of this worker
+            os.unlink(path)
+        reactor.listenUNIX(path, BusFactory(self))
+
+    def deliver(self, dest, destchan, message, fromnick, fromserver, received):
+        """Queue a message relayed from another worker"""
+        queue = queues.get(dest)
+        if queue is None or queue.remote:
+            logger.error('Worker {0} :: Received message for {1} which it does not own'.format(self.index, dest))
+            return
+        # the sending worker remembers it too, but echoes will come back here
+        seen = dedup.cache
+        if seen.enabled:
+            # the origin channel isn't sent over the bus
+            seen.check(dest, destchan, seen.fingerprint(fromnick, message), seen.source(fromserver, None, fromnick))
+        queue.put(destchan, message, fromnick, fromserver, received)
+
+    def watch_parent(self):
+        """Exit if the supervisor goes away"""
+        ppid = os.getppid()
+        def check():
+            if os.getppid() != ppid:
+                watcher.stop()
+                logger.error('Worker {0} :: Supervisor exited, stopping'.format(self.index))
+                try:
+                    reactor.stop()
+                except ReactorNotRunning:
+                    # already shutting down
+                    pass
+        watcher = LoopingCall(check)
+        watcher.start(2, now=False)
+
+
+def start_worker(conf, index, ipc_dir):
+    from .main import start
+    worker = Worker(conf, index, ipc_dir)
+    worker.listen()
+    worker.watch_parent()
+    start(conf, worker)
+    logger.info('Worker {0} :: Started with {1}'.format(
+        index, ', '.join(name for name, owner in sorted(worker.owners.items()) if owner == index)))
+    return worker
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.supervisor.ended(self.index, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(object):
+    """Starts `workers` processes running `argv` and restarts any that exit
+
+    Each worker owns a share of the servers, messages for servers owned by
+    another worker go over a Unix socket bus in `ipc_dir`
+    """
+
+    def __init__(self, conf, argv):
+        self.conf = conf
+        self.argv = argv
+        self.workers = conf['workers']
+        self.ipc_dir = conf.get('ipc_dir') or tempfile.mkdtemp(prefix='chatrelay-')
+        self.procs = {}
+        self.owners = {}
+        self.backoffs = [Backoff(conf) for i in range(self.workers)]
+        self.stopping = False
+
+    def start(self):
+        logsetup.configure(self.conf)
+        self.reassign(self.conf)
+        for index in range(self.workers):
+            names = [name for name, owner in sorted(self.owners.items()) if owner == index]
+            if not names:
+                logger.warn('Worker {0} :: No servers assigned'.format(index))
+            self.spawn(index)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def reassign(self, conf):
+        """Assign servers in `conf` to workers and write it where they read it
+
+        Servers keep their worker and the number of workers never changes while
+        running, so a reload only moves servers whose `worker` pin changed
+        """
+        self.owners = assign(conf, self.workers, self.owners)
+        tmpname = owners_path(self.ipc_dir) + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({'workers': self.workers, 'owners': self.owners}, f)
+        os.rename(tmpname, owners_path(self.ipc_dir))
+
+    def spawn(self, index):
+        env = dict(os.environ, CHATRELAY_WORKER=str(index), CHATRELAY_IPC_DIR=self.ipc_dir)
+        self.backoffs[index].connected()
+        proto = WorkerProcess(self, index)
+        reactor.spawnProcess(proto, self.argv[0], self.argv, env=env, childFDs={0: 0, 1: 1, 2: 2})
+        self.procs[index] = proto
+        logger.info('Worker {0} :: Spawned pid {1}'.format(index, proto.transport.pid))
+
+    def ended(self, index, reason):
+        del self.procs[index]
+        if self.stopping:
+            return
+        delay = self.backoffs[index].next_delay()
+        logger.error('Worker {0} :: Exited ({1}), restarting in {2}s'.format(index, reason.getErrorMessage(), delay))
+        reactor.callLater(delay, self.spawn, index)
+
+    def reload(self, conf):
+        """Have every worker reload the config file, `conf` as just loaded from it"""
+        self.reassign(conf)
+        logger.info('Signalling workers to reload')
+        for proto in self.procs.values():
+            proto.transport.signalProcess('HUP')
+
+    def stop(self):
+        """Stop every worker, the returned Deferred fires once they have exited"""
+        self.stopping = True
+        waiting = []
+        for proto in self.procs.values():
+            proto.transport.signalProcess('TERM')
+            waiting.append(proto.ended)
+        return defer.DeferredList(waiting)
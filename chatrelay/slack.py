@@ -1,19 +1,120 @@
-from . import servers, BasicFactory
+from . import routers, build_router, route, register, unregister, announce, metrics, recorder, trace, Backoff, LRUCache, changed_keys, update_conf
+from .web import JSONClient
 from autobahn.twisted.websocket import WebSocketClientProtocol, WebSocketClientFactory
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateResponse, PerMessageDeflateResponseAccept
 from autobahn.websocket.util import parse_url as parse_ws_url
-from twisted.internet import reactor, ssl
+from collections import deque
+from twisted.internet import reactor, ssl, defer
+from twisted.python.failure import Failure
+from time import time
 import json
 import logging
 import re
-import requests
 
 logger = logging.getLogger('chatrelay')
 
-def apiurl(tail):
-    return 'https://slack.com/api/'+tail
+# RTM frames are decoded with the fastest JSON library available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
+# an event type given as the first key can be checked without decoding the frame
+_frame_type_re = re.compile(br'\{\s*"type"\s*:\s*"([a-z_]+)"')
+
+class SlackAPIError(Exception):
+    """Raised through the errback chain when the Slack API responds with ok=false"""
+
+    def __init__(self, method, res):
+        Exception.__init__(self, '{0} failed: {1}'.format(method, res.get('error')))
+        self.method = method
+        self.res = res
+
+
+class SlackAPI(JSONClient):
+    """Async Slack Web API client, one per workspace connection"""
+
+    def __init__(self, conf):
+        JSONClient.__init__(self, conf.get('api_concurrency', 4), conf.get('api_timeout', 30))
+        self.token = conf['api_token']
+        self.url = conf.get('api_url', 'https://slack.com/api/')
+
+    def call(self, method, **params):
+        """Returns a Deferred firing with the API response dict"""
+        params['token'] = self.token
+        d = self.request('POST', self.url + method, form=params)
+        d.addCallback(self._check, method)
+        return d
+
+    def _check(self, res, method):
+        if not res['ok']:
+            raise SlackAPIError(method, res)
+        return res
+
+_mention_re = re.compile(r'<@(U[A-Z0-9]+)>')
+
+transforms = {}
+
+def _trie_regex(words):
+    """Build a regex matching any of `words`, factored into a trie of common prefixes"""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = None
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ''
+        optional = '' in node
+        if len(alts) == 1 and not optional:
+            return alts[0]
+        return '(?:' + '|'.join(alts) + ')' + ('?' if optional else '')
+
+    return build(trie)
+
+class MessageTransform(object):
+    """Compiled single pass rewrite of Slack markup and emoji_map names"""
+
+    def __init__(self, emoji_map):
+        self.emoji_map = dict(emoji_map or {})
+        parts = [
+            r'<@(?P<uid>U[A-Z0-9]+)(?:\|(?P<uname>[^>]+))?>',
+            r'<#C[A-Z0-9]+\|(?P<cname>[^>]+)>',
+        ]
+        if self.emoji_map:
+            parts.append('(?P<emoji>' + _trie_regex(self.emoji_map) + ')')
+        self.pattern = re.compile('|'.join(parts))
+
+    def apply(self, text, user_name):
+        """Rewrite `text`, calling `user_name(id)` for bare user mentions"""
+        return self.pattern.sub(lambda m: self._replace(m, user_name), text)
+
+    def _replace(self, m, user_name):
+        kind = m.lastgroup
+        if kind == 'emoji':
+            return self.emoji_map[m.group(0)]
+        elif kind == 'uname':
+            return '@' + m.group('uname')
+        elif kind == 'cname':
+            return '#' + m.group('cname')
+        else:
+            return '@' + user_name(m.group('uid'))
+
+def build_transform(conf):
+    """(Re)build the message transform for a connection, call whenever its emoji_map changes"""
+    transforms[conf['name']] = MessageTransform(conf.get('emoji_map'))
 
 class SlackBot(WebSocketClientProtocol):
     SILENT_IGNORE = ('hello', 'user_typing', 'reconnect_url', 'presence_change')
+    _skip_types = frozenset(t.encode('ascii') for t in SILENT_IGNORE)
+
+    _inbound = None
 
     def onConnect(self, response):
         logger.debug('{0} :: Connected'.format(self.conf['name']))
@@ -23,7 +124,7 @@ class SlackBot(WebSocketClientProtocol):
 
     def relay_message(self, destchan, message, fromnick=None, fromserver=None):
         if not self.conf.get('relay_service_messages', True) and not fromnick:
-            logger.debug('{0} :: Ignoring service message'.format(self.conf['name']))
+            logger.debug('%s :: Ignoring service message', self.conf['name'])
             return
 
         # remove hash mark if configured on other servers
@@ -31,37 +132,28 @@ class SlackBot(WebSocketClientProtocol):
 
         # prepare postMessage request
         params = {
-            'token': self.conf['api_token'],
             'channel': destchan,
             'text': message,
-            'as_user': True,
+            'as_user': 'true',
         }
         if fromnick:
             # disambiguate sender
-            current_users = self._state.users.values()
-            if fromnick in current_users:
-                fromnick += '_'+fromserver
-            while fromnick in current_users:
-                fromnick += '_'
+            fromnick = self._state.display_name(fromnick, fromserver)
 
             # update request
-            params['as_user'] = False
+            params['as_user'] = 'false'
             params['username'] = fromnick
 
         # send request
-        logger.debug('{0} => username={1} channel={2} :{3}'.format(self.conf['name'], fromnick, destchan, message))
-        m = requests.get(apiurl('chat.postMessage'), params=params)
-        res = m.json()
-        if not res['ok']:
-            logger.error('>> Failed to post message, response:\n{0}'.format(m.text))
-            raise RuntimeError('Failed to post message to {0}'.format(self.conf['name']))
+        trace.debug(u'%s => username=%s channel=%s :%s', self.conf['name'], fromnick, destchan, message)
+        return self.factory.session.coalescer.post(params)
 
-    def _replace_userid(self, m):
+    def _mention_name(self, id):
         try:
-            return '@'+self._state.users[m.group(1)]
+            return self._state.get_user(id)
         except KeyError:
-            logger.warn('{0} :: Unknown user ID for @-mention')
-            return '@unknown'
+            logger.warn('{0} :: Unknown user ID for @-mention'.format(self.conf['name']))
+            return 'unknown'
 
     def _prepare_mtext(self, msg):
         if 'text' in msg:
@@ -74,25 +166,40 @@ class SlackBot(WebSocketClientProtocol):
         for attachment in msg.get('attachments', []):
             msgparts.append(attachment['fallback'])
         mtext = ' | '.join(msgparts)
+        if not mtext:
+            logger.warning('>> Could not find any message to send')
+            return mtext
 
-        # replace any user IDs with username
-        mtext = re.sub(r'<@U[A-Z0-9]+\|([^>]+)>', r'@\1', mtext)
-        mtext = re.sub(r'<@(U[A-Z0-9]+)>', self._replace_userid, mtext)
-
-        # replace channel IDs
-        mtext = re.sub(r'<#C[A-Z0-9]+\|([^>]+)>', r'#\1', mtext)
-
-        # replace emojis
-        for name, emoji in self.conf.get('emoji_map', {}).items():
-            mtext = mtext.replace(name, emoji)
-        return mtext
+        # replace user and channel IDs with names, and emojis, in one pass
+        return transforms[self.conf['name']].apply(mtext, self._mention_name)
 
     def onMessage(self, payload, isBinary):
         if isBinary:
             raise RuntimeError('Slack sent binary websocket message')
-        payload = payload.decode('utf-8')
-        logger.debug(u'{0} <= {1}'.format(self.conf['name'], payload))
-        msg = json.loads(payload)
+        name = self.conf['name']
+        if recorder.enabled:
+            recorder.record(name, 'frame', payload.decode('utf-8'))
+
+        # most frames on a busy workspace are ignored event types, drop them
+        # before decoding anything
+        m = _frame_type_re.match(payload)
+        if m is not None and m.group(1) in SlackBot._skip_types:
+            if metrics.enabled:
+                metrics.inc('inbound_skipped', name)
+                metrics.inc('inbound_bytes', name, len(payload))
+            return
+
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug(u'%s <= %s', name, payload.decode('utf-8'))
+        if metrics.enabled:
+            received = time()
+            msg = json_loads(payload)
+            metrics.observe('parse', name, time() - received)
+            metrics.inc('inbound_messages', name)
+            metrics.inc('inbound_bytes', name, len(payload))
+        else:
+            received = None
+            msg = json_loads(payload)
         mtype = msg['type']
         if mtype in SlackBot.SILENT_IGNORE:
             pass
@@ -106,112 +213,451 @@ class SlackBot(WebSocketClientProtocol):
                 logger.debug('>> Ignoring hidden subtype')
                 return
 
-            # Obtain channel name and user name
-            try:
-                channel = self._state.channels[msg['channel']]
-            except KeyError:
-                logger.debug('>> Unknown channel ID')
-                return
-            if 'username' in msg:
-                user = msg['username']
-            elif 'user' in msg:
-                user = self._state.users[msg['user']]
-            else:
-                logger.warn('{0} :: Cannot find user name for message, using default'.format(self.conf['name']))
-                user = self.conf['default_username']
-
-            # Prepare message text
-            mtext = self._prepare_mtext(msg)
-            if not mtext:
-                logger.warning('>> Could not find any message to send')
-                return
-            logger.debug(u'>> Recvd message from {0} to {1}: {2}'.format(user, channel, mtext))
-
-            # Do relay
-            try:
-                map = self.conf['channel_map'][channel]
-                for dest, destchan in map.items():
-                    servers[dest].relay_message(destchan, mtext, user, self.conf['name'])
-            except KeyError:
-                logger.debug('>> Channel {0} not mapped'.format(channel))
-                return
+            # Names may need to be looked up, so handle messages through a
+            # Deferred chain to keep them in order
+            if self._inbound is None:
+                self._inbound = defer.succeed(None)
+            self._inbound.addCallback(lambda _: self._relay_message_event(msg, received))
+            self._inbound.addErrback(self._relay_failed)
         elif mtype == 'user_change' or mtype == 'team_join':
             id = msg['user']['id']
             name = msg['user']['name']
-            self._state.users[id] = name
+            self._state.set_user(id, name)
             logger.debug('>> Recvd user: {0} => {1}'.format(id, name))
         elif mtype == 'channel_created' or mtype == 'channel_rename':
             id = msg['channel']['id']
             name = msg['channel']['name']
-            self._state.channels[id] = name
+            self._state.set_channel(id, name)
             logger.debug('>> Recvd channel: {0} => {1}'.format(id, name))
         else:
-            logger.debug('>> Ignoring unhandled type {0}'.format(mtype))
+            logger.debug('>> Ignoring unhandled type %s', mtype)
+
+    @defer.inlineCallbacks
+    def _relay_message_event(self, msg, received=None):
+        # Obtain channel name and user name
+        channel = yield self._state.lookup_channel(msg['channel'])
+        if channel is None:
+            logger.debug('>> Unknown channel ID')
+            return
+        if not routers[self.conf['name']].get(channel):
+            logger.debug('>> Channel %s not mapped', channel)
+            return
+        if 'username' in msg:
+            user = msg['username']
+        elif 'user' in msg:
+            user = yield self._state.lookup_user(msg['user'])
+        else:
+            user = None
+        if user is None:
+            logger.warn('{0} :: Cannot find user name for message, using default'.format(self.conf['name']))
+            user = self.conf['default_username']
+        if recorder.enabled:
+            recorder.record_name(self.conf['name'], 'channel', msg['channel'], channel)
+            if 'user' in msg:
+                recorder.record_name(self.conf['name'], 'user', msg['user'], user)
+
+        # make sure @-mentioned users are known
+        mentions = set(_mention_re.findall(msg.get('text', '')))
+        if mentions:
+            yield defer.gatherResults([self._state.lookup_user(id) for id in mentions])
+
+        # Do relay, the message text is prepared by route()
+        logger.debug(u'>> Recvd message from %s to %s', user, channel)
+        route(self.conf['name'], channel, msg, user, self._prepare_mtext, received)
+
+    def _relay_failed(self, failure):
+        logger.error('{0} :: Failed to handle message: {1}'.format(self.conf['name'], failure.getErrorMessage()))
 
     def onClose(self, wasClean, code, reason):
         logger.debug('{0} :: Closed: wasClean={1} code={2} reason={3}'.format(self.conf['name'], wasClean, code, reason))
+        unregister(self.conf['name'], self)
 
 
 class SlackWSFactory(WebSocketClientFactory):
     protocol = SlackBot
 
+    # settings reconfigure() can change without reconnecting
+    LIVE_KEYS = ('channel_map', 'emoji_map', 'relay_service_messages', 'default_username',
+                 'coalesce_window', 'coalesce_max_delay', 'coalesce_max_length')
+
     @classmethod
     def init_connection(cls, conf):
-        # Remove hash marks from configured channels if present
-        channel_map = {}
-        for mychannel, map in conf['channel_map'].items():
-            mychannel = mychannel.lstrip('#')
-            channel_map[mychannel] = map
-        conf['channel_map'] = channel_map
-
-        # Get server state and RTM setup info
-        rtmc = requests.get(apiurl('rtm.start'), params={'token': conf['api_token']})
-        res = rtmc.json()
-        if not res['ok']:
-            logger.debug('Slack API rtm.start response:\n{0}'.format(rtmc.text))
-            raise RuntimeError('Failed to connect to Slack')
+        strip_channels(conf)
+        build_router(conf)
+        build_transform(conf)
+
+        api = SlackAPI(conf)
+        if conf.get('rtm_connect'):
+            # the lazily filled state is kept across reconnects
+            state = State(conf, api)
+        else:
+            state = None
+        session = Session(conf, api, Backoff(conf), state)
+        cls.start(session)
+        return session
+
+    @classmethod
+    def reconfigure(cls, conf, new):
+        """Apply `new` settings to the running connection for `conf`
+
+        Returns False without changing anything if a reconnect is needed
+        """
+        new = dict(new)
+        strip_channels(new)
+        if changed_keys(conf, new) - set(cls.LIVE_KEYS):
+            return False
+        update_conf(conf, new)
+        build_transform(conf)
+        return True
+
+    @classmethod
+    def start(cls, session):
+        # Get server state and RTM setup info without blocking the reactor
+        if session.state is None:
+            d = session.api.call('rtm.start')
+        else:
+            d = session.api.call('rtm.connect')
+        d.addCallback(cls._rtm_started, session)
+        d.addErrback(cls._rtm_failed, session)
+        return d
+
+    @classmethod
+    def _rtm_failed(cls, failure, session):
+        if session.stopping:
+            return
+        delay = session.backoff.next_delay()
+        logger.error('{0} :: Failed to connect to Slack: {1}, retrying in {2}s'.format(
+            session.conf['name'], failure.getErrorMessage(), delay))
+        session.retry(delay, cls.start)
+
+    @classmethod
+    def _rtm_started(cls, res, session):
+        if session.stopping:
+            return
+        conf = session.conf
         wsurl = res['url']
         logger.debug('{0} :: Got websocket url = {1}'.format(conf['name'], wsurl))
-        logger.debug('{0} :: rtm.start response\n{1}'.format(
-            conf['name'], json.dumps(res, indent=2, separators=(',', ': '))))
-        slackbot_username = conf.get('slackbot_username', conf['default_username'])
-        state = State(res, slackbot_username)
-        factory = cls(conf, state, wsurl)
+        if session.state is None:
+            factory = cls(session, State(conf, session.api, res), wsurl)
+        else:
+            factory = cls(session, session.state, wsurl)
+        session.factory = factory
 
         # Start RTM connection
         isSecure, host, port, resource, path, params = parse_ws_url(wsurl)
         logger.debug('{0} :: Connecting to {1}:{2} secure={3}'.format(conf['name'], host, port, isSecure))
         if isSecure:
-            reactor.connectSSL(host, port, factory, ssl.ClientContextFactory())
+            factory.connector = reactor.connectSSL(host, port, factory, ssl.ClientContextFactory())
         else:
-            reactor.connectTCP(host, port, factory)
+            factory.connector = reactor.connectTCP(host, port, factory)
 
-    def __init__(self, conf, _state, wsurl):
-        self.conf = conf
+    def __init__(self, session, _state, wsurl):
+        self.session = session
+        self.conf = session.conf
         self._state = _state
+        self.api = session.api
+        self.backoff = session.backoff
+        self.connector = None
         WebSocketClientFactory.__init__(self, wsurl)
 
+        # websocket ping frames detect half-open connections, autobahn closes
+        # the connection if no pong arrives in time
+        ping_interval = self.conf.get('ping_interval', 60)
+        if ping_interval:
+            self.setProtocolOptions(autoPingInterval=ping_interval,
+                                    autoPingTimeout=self.conf.get('ping_timeout', 15))
+
+        # ask for permessage-deflate, used if the server agrees
+        if self.conf.get('ws_compression', True):
+            self.setProtocolOptions(perMessageCompressionOffers=[PerMessageDeflateOffer()],
+                                    perMessageCompressionAccept=_accept_deflate)
+
+    def clientConnectionLost(self, connector, reason):
+        logger.error('{0} :: Connection lost ({1})'.format(self.conf['name'], reason))
+        self._restart('Lost connection to')
+
+    def clientConnectionFailed(self, connector, reason):
+        logger.error('{0} :: Connection failed ({1})'.format(self.conf['name'], reason))
+        self._restart('Failed to connect to')
+
+    def _restart(self, what):
+        # RTM websocket URLs are single use, so reconnecting means a new rtm.start
+        if self.session.stopping:
+            return
+        name = self.conf['name']
+        unregister(name)
+        delay = self.backoff.next_delay()
+        announce(name, '{0} {1}, retrying in {2}s'.format(what, name, delay))
+        logger.info('{0} :: Retrying in {1}s'.format(name, delay))
+        self.session.retry(delay, self.start)
+
     def buildProtocol(self, addr):
         # Set up websocket protocol
         name = self.conf['name']
         logger.debug('{0} :: buildProtocol'.format(name))
+        self.backoff.connected()
         proto = WebSocketClientFactory.buildProtocol(self, addr)
         proto.conf = self.conf
         proto._state = self._state
+        proto.api = self.api
 
         # Register the protocol object globally
-        servers[name] = proto
+        register(name, proto)
 
         return proto
 
 
+def _accept_deflate(response):
+    if isinstance(response, PerMessageDeflateResponse):
+        return PerMessageDeflateResponseAccept(response)
+
+
+def strip_channels(conf):
+    """Remove hash marks from configured channels if present"""
+    channel_map = {}
+    for mychannel, map in conf['channel_map'].items():
+        mychannel = mychannel.lstrip('#')
+        channel_map[mychannel] = map
+    conf['channel_map'] = channel_map
+
+
+class Session(object):
+    """A configured Slack connection across RTM sessions, returned by init_connection()
+
+    The lazily filled State, if any, is kept for the whole lifetime
+    """
+
+    def __init__(self, conf, api, backoff, state=None):
+        self.conf = conf
+        self.api = api
+        self.backoff = backoff
+        self.state = state
+        self.factory = None
+        self.coalescer = Coalescer(conf, api)
+        self.stopping = False
+        self._retry = None
+
+    def retry(self, delay, start):
+        self._retry = reactor.callLater(delay, start, self)
+
+    def stop(self):
+        """Disconnect for good"""
+        self.stopping = True
+        unregister(self.conf['name'])
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        if self.factory is not None and self.factory.connector is not None:
+            self.factory.connector.disconnect()
+        self.coalescer.flush_all()
+        self.api.close()
+
+
+class Coalescer(object):
+    """Merges consecutive messages from one sender to one channel into a single post
+
+    Slack allows about one chat.postMessage per second per channel, so a
+    multi-line paste would otherwise trickle in. A message is held for
+    `coalesce_window` seconds (default 0.5) waiting for the next line from the
+    same sender, but never more than `coalesce_max_delay` (default 2) in total,
+    and lines are joined up to `coalesce_max_length` characters (default 4000).
+    Posts to a channel are sent one at a time to keep their order. A window of
+    0 posts every message as it comes.
+    """
+
+    def __init__(self, conf, api):
+        self.conf = conf
+        self.api = api
+        # channel -> Run collecting lines, and Runs waiting for the post in flight
+        self.pending = {}
+        self.sending = {}
+
+    def post(self, params):
+        """Returns a Deferred firing with the chat.postMessage response of the merged post"""
+        window = self.conf.get('coalesce_window', 0.5)
+        if not window:
+            return self.api.call('chat.postMessage', **params)
+        channel = params['channel']
+        text = params.pop('text')
+        now = time()
+        run = self.pending.get(channel)
+        if run is not None:
+            if (run.params == params and run.length + 1 + len(text) <= self.conf.get('coalesce_max_length', 4000)
+                    and now < run.deadline):
+                run.call.reset(min(window, run.deadline - now))
+                return run.add(text)
+            self.flush(channel)
+        run = self.pending[channel] = Run(params, now + self.conf.get('coalesce_max_delay', 2))
+        run.call = reactor.callLater(min(window, run.deadline - now), self.flush, channel)
+        return run.add(text)
+
+    def flush(self, channel):
+        run = self.pending.pop(channel)
+        if run.call.active():
+            run.call.cancel()
+        waiting = self.sending.get(channel)
+        if waiting is None:
+            self.sending[channel] = deque()
+            self._send(channel, run)
+        else:
+            waiting.append(run)
+
+    def flush_all(self):
+        for channel in list(self.pending):
+            self.flush(channel)
+
+    def _send(self, channel, run):
+        d = self.api.call('chat.postMessage', text=u'\n'.join(run.lines), **run.params)
+        d.addBoth(self._posted, channel, run)
+
+    def _posted(self, result, channel, run):
+        for waiter in run.waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        waiting = self.sending[channel]
+        if waiting:
+            self._send(channel, waiting.popleft())
+        else:
+            del self.sending[channel]
+
+
+class Run(object):
+    """Lines from one sender waiting to be posted to a channel as one message"""
+
+    def __init__(self, params, deadline):
+        self.params = params
+        self.deadline = deadline
+        self.lines = []
+        self.length = -1
+        self.waiters = []
+        self.call = None
+
+    def add(self, text):
+        self.lines.append(text)
+        self.length += 1 + len(text)
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+
 class State(object):
-    def __init__(self, rtm_start_res, slackbot_username):
-        self.users = {'USLACKBOT':slackbot_username}
+    """Slack user and channel ID -> name mappings
+
+    Filled completely from an rtm.start response if one is given, otherwise
+    entries are looked up with the Web API on first sight and kept in an LRU
+    cache. Either way, unknown IDs are looked up when first needed.
+    """
+
+    def __init__(self, conf, api, rtm_start_res=None):
+        self.api = api
+        self.slackbot_username = conf.get('slackbot_username', conf['default_username'])
+        self._inflight = {}
+
+        # memoized (fromserver, fromnick) -> name to post relayed messages as
+        self._display_names = LRUCache(conf.get('state_cache_size', 5000))
+
+        # lowercase user name -> ID of the users in self.users, bounded the
+        # same way
+        if rtm_start_res is None:
+            size = conf.get('state_cache_size', 5000)
+            ttl = conf.get('state_cache_ttl', 3600)
+            self.users = LRUCache(size, ttl)
+            self.names = LRUCache(size, ttl)
+            self.channels = LRUCache(size, ttl)
+            return
+
+        self.users = {}
+        self.names = {}
         for user in rtm_start_res['users']:
-            self.users[user['id']] = user['name']
+            self.set_user(user['id'], user['name'])
 
+        # non-member channels map to None
         self.channels = {}
         for channel in rtm_start_res['channels']:
             if channel['is_member']:
                 self.channels[channel['id']] = channel['name']
+            else:
+                self.channels[channel['id']] = None
+        logger.debug('{0} :: rtm.start loaded {1} users, {2} channels'.format(
+            conf['name'], len(self.users), len(self.channels)))
+
+    def get_user(self, id):
+        if id == 'USLACKBOT':
+            return self.slackbot_username
+        return self.users[id]
+
+    def set_user(self, id, name):
+        old = self.users.get(id)
+        if old is not None and self.names.get(old.lower()) == id:
+            del self.names[old.lower()]
+        self.users[id] = name
+        if name is not None:
+            self.names[name.lower()] = id
+
+    def name_taken(self, name):
+        name = name.lower()
+        return name == self.slackbot_username.lower() or name in self.names
+
+    def display_name(self, fromnick, fromserver):
+        """Name to post a relayed message as, avoiding names of workspace users"""
+        key = (fromserver, fromnick)
+        name = self._display_names.get(key)
+        if name is None or self.name_taken(name):
+            name = fromnick
+            if fromserver and self.name_taken(name):
+                name += '_'+fromserver
+            while self.name_taken(name):
+                name += '_'
+            self._display_names[key] = name
+        return name
+
+    def set_channel(self, id, name):
+        self.channels[id] = name
+
+    def lookup_user(self, id):
+        """Returns a Deferred firing with the user name, or None if unknown"""
+        try:
+            return defer.succeed(self.get_user(id))
+        except KeyError:
+            return self._lookup('users.info', 'user', id, self.set_user, self._user_name)
+
+    def lookup_channel(self, id):
+        """Returns a Deferred firing with the channel name, or None if unknown or not joined"""
+        try:
+            return defer.succeed(self.channels[id])
+        except KeyError:
+            return self._lookup('conversations.info', 'channel', id, self.set_channel, self._channel_name)
+
+    def _user_name(self, res):
+        return res['user']['name']
+
+    def _channel_name(self, res):
+        channel = res['channel']
+        if channel.get('is_member') and 'name' in channel:
+            return channel['name']
+        return None
+
+    def _lookup(self, method, param, id, store, extract):
+        # share a single API call between everything waiting on the same ID
+        key = (method, id)
+        waiter = defer.Deferred()
+        if key in self._inflight:
+            self._inflight[key].append(waiter)
+            return waiter
+        self._inflight[key] = [waiter]
+        d = self.api.call(method, **{param: id})
+        d.addCallback(extract)
+        d.addCallback(self._looked_up, key, id, store)
+        d.addErrback(self._lookup_failed, key, method, id)
+        return waiter
+
+    def _looked_up(self, name, key, id, store):
+        store(id, name)
+        for waiter in self._inflight.pop(key):
+            waiter.callback(name)
+
+    def _lookup_failed(self, failure, key, method, id):
+        logger.warn('Slack {0} for {1} failed: {2}'.format(method, id, failure.getErrorMessage()))
+        for waiter in self._inflight.pop(key):
+            waiter.callback(None)
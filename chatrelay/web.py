@@ -0,0 +1,74 @@
+from . import tobytes, tostr
+from io import BytesIO
+from twisted.internet import reactor, defer
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+import json
+import logging
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+logger = logging.getLogger('chatrelay')
+
+class HTTPError(Exception):
+    """Raised through the errback chain for non-2xx HTTP responses"""
+
+    def __init__(self, code, body):
+        Exception.__init__(self, 'HTTP {0}'.format(code))
+        self.code = code
+        self.body = body
+
+
+class JSONClient(object):
+    """Deferred-based JSON HTTP client using a persistent keep-alive connection pool
+
+    At most `concurrency` requests are in flight at once, the rest wait their turn.
+    A request that has not been answered in full within `timeout` seconds is
+    cancelled and its Deferred fails, so a stalled server can't hold a slot
+    forever.
+    """
+
+    def __init__(self, concurrency=4, timeout=30):
+        self.timeout = timeout
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, connectTimeout=timeout, pool=self.pool)
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+
+    def request(self, method, url, params=None, form=None, json_body=None, headers=None):
+        """Returns a Deferred firing with the decoded JSON response body"""
+        return self.semaphore.run(self._request, method, url, params, form, json_body, headers)
+
+    def _request(self, method, url, params, form, json_body, headers):
+        if params:
+            url += '?' + urlencode(params)
+        hdrs = Headers()
+        for k, v in (headers or {}).items():
+            hdrs.addRawHeader(k, v)
+        body = None
+        if form is not None:
+            hdrs.setRawHeaders('Content-Type', ['application/x-www-form-urlencoded'])
+            body = FileBodyProducer(BytesIO(tobytes(urlencode(form))))
+        elif json_body is not None:
+            hdrs.setRawHeaders('Content-Type', ['application/json'])
+            body = FileBodyProducer(BytesIO(tobytes(json.dumps(json_body))))
+        d = self.agent.request(tobytes(method), tobytes(url), hdrs, body)
+        d.addCallback(self._read_response)
+        d.addTimeout(self.timeout, reactor)
+        return d
+
+    def _read_response(self, response):
+        d = readBody(response)
+        d.addCallback(self._decode, response.code)
+        return d
+
+    def _decode(self, body, code):
+        if not 200 <= code < 300:
+            raise HTTPError(code, body)
+        return json.loads(tostr(body))
+
+    def close(self):
+        return self.pool.closeCachedConnections()
@@ -1,12 +1,33 @@
-from importlib import import_module
+from chatrelay import shard
+from chatrelay.main import start, reload
 from twisted.internet import reactor
 import logging
+import os
+import signal
 import sys
 import yaml
 
 logger = logging.getLogger('chatrelay')
 logger.addHandler(logging.NullHandler())
-logger.setLevel(logging.DEBUG)
+
+def load(config_fn):
+    with open(config_fn) as f:
+        return yaml.load(f)
+
+def reload_config(config_fn, conf, worker=None):
+    """Apply changes to the config file, on SIGHUP"""
+    logger.info('Reloading {0}'.format(config_fn))
+    try:
+        reload(conf, load(config_fn), worker)
+    except Exception:
+        logger.exception('Reload :: Failed to apply {0}'.format(config_fn))
+
+def reload_supervisor(config_fn, supervisor):
+    """Reassign servers to workers and have them reload, on SIGHUP"""
+    try:
+        supervisor.reload(load(config_fn))
+    except Exception:
+        logger.exception('Reload :: Failed to apply {0}'.format(config_fn))
 
 def run():
     """main entry point"""
@@ -17,23 +38,21 @@ def run():
         config_fn = 'config.yaml'
     print("Using config file {0}".format(config_fn))
 
-    with open(config_fn) as f:
-        conf = yaml.load(f)
-
-    if conf['log_level']:
-        stderrHandler = logging.StreamHandler()
-        stderrHandler.setLevel(getattr(logging, conf['log_level']))
-        logger.addHandler(stderrHandler)
-
-    names = set()
-    for server in conf['servers']:
-        name = server['name']
-        if name in names:
-            raise RuntimeError('Duplicate server name in {0}: {1}'.format(config_fn, name))
-        else:
-            names.add(name)
-        modname, objname = conf['protocols'][server['protocol']]
-        getattr(import_module(modname), objname).init_connection(server)
+    conf = load(config_fn)
+
+    worker = os.environ.get('CHATRELAY_WORKER')
+    if worker is not None:
+        # spawned by the supervisor below
+        worker = shard.start_worker(conf, int(worker), os.environ['CHATRELAY_IPC_DIR'])
+        on_hangup = lambda: reload_config(config_fn, conf, worker)
+    elif conf.get('workers'):
+        supervisor = shard.Supervisor(conf, [sys.executable, os.path.abspath(sys.argv[0]), config_fn])
+        supervisor.start()
+        on_hangup = lambda: reload_supervisor(config_fn, supervisor)
+    else:
+        start(conf)
+        on_hangup = lambda: reload_config(config_fn, conf)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(on_hangup))
     reactor.run()
 
 if __name__ == '__main__':
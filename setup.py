@@ -11,9 +11,12 @@ setup(
         'twisted',
         'autobahn',
         'pyopenssl',
-        'requests',
         'service_identity',
     ],
+    extras_require={
+        # faster decoding of Slack RTM events
+        'fastjson': ['orjson'],
+    },
     dependency_links=[
         'git+https://github.com/matrix-org/synapse.git',
     ],